@@ -0,0 +1,350 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+# Run Epa Multi Calls and Additional Demand Check without the QGIS desktop. From the QGIS plugins folder:
+#   python3 -m gw_epatools_plugin.cli multicalls --config example.config --output out --service giswater --schema ws
+#   python3 -m gw_epatools_plugin.cli adc --inp network.inp --config example.in --output out --name night
+#   python3 -m gw_epatools_plugin.cli worker --jobs out/night-jobs
+# QGIS is only imported by the commands that need it: workers only need Python and the EPA engine.
+import argparse
+import datetime
+import json
+import os
+import sys
+from pathlib import Path
+from threading import Thread
+from time import time
+
+from . import settings
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_ARGUMENTS = 2
+EXIT_CANCELED = 130
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10
+
+
+def main(argv=None):
+
+    args = _parse_args(argv)
+
+    # Shown before anything is initialized: it only needs the config file
+    if args.command == "multicalls" and args.plan:
+        return _show_plan(args)
+    if args.command == "worker":
+        return run_worker(args)
+
+    from qgis.core import QgsApplication
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    try:
+        if not init_headless():
+            return EXIT_FAILED
+        if args.command == "multicalls":
+            return run_multi_calls(args)
+        return run_add_demand_check(args)
+    finally:
+        app.exitQgis()
+
+
+def init_headless():
+    """ Initialize the Giswater modules and the global variables that main.init_plugin sets in QGIS """
+
+    from . import global_vars
+
+    settings.init_plugin()
+    if settings.giswater_folder is None:
+        _print_error("Giswater plugin not found. Set QGIS_PLUGINPATH to the QGIS plugins folder.")
+        return False
+
+    plugin_dir = os.path.dirname(__file__)
+    giswater_dir = settings.get_giswater_folder(get_full_path=True)
+    plugin_name = settings.tools_qgis.get_plugin_metadata('name', 'giswater', plugin_dir)
+    giswater_plugin_name = settings.tools_qgis.get_plugin_metadata('name', 'giswater', giswater_dir)
+    major_version = settings.tools_qgis.get_major_version(giswater_dir)
+    roaming_user_dir = f'{settings.tools_os.get_datadir()}{os.sep}{giswater_plugin_name}{os.sep}{major_version}'
+    global_vars.init_global(None, None, plugin_dir, plugin_name, roaming_user_dir)
+
+    user_folder_name = plugin_name.replace('gw_', '').replace('_plugin', '')
+    os.makedirs(f"{roaming_user_dir}{os.sep}{user_folder_name}", exist_ok=True)
+    global_vars.user_folder_name = user_folder_name
+    return True
+
+
+def connect_database(args):
+    """ Connect the Giswater connection to the database and set the schema of the project """
+
+    from . import global_vars
+
+    tools_db = settings.tools_db
+    if args.service:
+        status = tools_db.connect_to_database_service(args.service, args.sslmode)
+    else:
+        password = args.password or os.environ.get('PGPASSWORD')
+        status = tools_db.connect_to_database(args.host, args.port, args.dbname, args.user, password, args.sslmode)
+    if not status:
+        _print_error(f"Couldn't connect to the database: {tools_db.dao.last_error if tools_db.dao else ''}")
+        return False
+
+    global_vars.schema_name = args.schema
+    for module in (settings.gw_global_vars, settings.lib_vars):
+        if module is not None and hasattr(module, 'schema_name'):
+            module.schema_name = args.schema
+    tools_db.execute_sql(f"SET search_path = {args.schema}, public;", is_thread=True)
+    return True
+
+
+def run_multi_calls(args):
+
+    if not connect_database(args):
+        return EXIT_FAILED
+
+    from . import global_vars
+    from .core.threads.recursive_epa import GwRecursiveEpa
+
+    config = _read_config(args.config)
+    os.makedirs(args.output, exist_ok=True)
+    task = GwRecursiveEpa("Recursive Go2Epa", args.prefix, args.output, config, global_vars.plugin_dir)
+    task.time_changed.connect(lambda text: print(text, flush=True))
+
+    result = _run_task(task, lambda: f"{task.cur_idx}/{task.total_objects} scenarios exported")
+
+    if task.files_exported:
+        print(f"Files generated: {len(task.files_exported)}")
+    if task.common_msg:
+        print(task.common_msg)
+    if task.stop or task.isCanceled():
+        _print_error("Task canceled.")
+        return EXIT_CANCELED
+    if task.error_msg:
+        _print_error(task.error_msg)
+    if task.exception:
+        _print_error(f"{type(task.exception).__name__}: {task.exception}")
+    if global_vars.session_vars['last_error']:
+        _print_error(global_vars.session_vars.get('last_error_msg') or global_vars.session_vars['last_error'])
+    if not result or task.error_msg or task.exception or task.function_failed:
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def run_add_demand_check(args):
+
+    from .core.threads.add_demand_check import GwAddDemandCheck
+    from .core.toolbars.epa.anl_add_demand_check import ConfigADC, get_nodes_from_db
+
+    if not Path(args.inp).exists():
+        _print_error(f"Input INP file not found: {args.inp}")
+        return EXIT_ARGUMENTS
+    try:
+        config = ConfigADC(args.config)
+    except Exception as e:
+        _print_error(f"Configuration file couldn't be imported: {e}")
+        return EXIT_ARGUMENTS
+
+    # The database is only used to read the nodes and to save the results
+    use_db = args.nodes == "database" or args.save_to_db
+    if use_db and not connect_database(args):
+        return EXIT_FAILED
+    if args.nodes == "database":
+        config.junctions = get_nodes_from_db()
+    if len(config.junctions) == 0:
+        _print_error("There are no nodes to check.")
+        return EXIT_ARGUMENTS
+
+    os.makedirs(args.output, exist_ok=True)
+    prefix = Path(args.output) / args.name
+    existing = [f"{prefix}{ext}" for ext in (".in", ".csv") if Path(f"{prefix}{ext}").exists()]
+    if existing and not args.overwrite:
+        _print_error(f"Output files already exist (use --overwrite): {', '.join(existing)}")
+        return EXIT_ARGUMENTS
+
+    results = {}
+    partial_file = Path(f"{prefix}-partial.json")
+    if args.resume and partial_file.exists():
+        with open(partial_file) as file:
+            results = json.load(file)
+
+    task = GwAddDemandCheck(
+        "Additional Demand Check",
+        args.inp,
+        config,
+        args.output,
+        args.name,
+        results,
+        save_to_db=args.save_to_db,
+    )
+    result = _run_task(
+        task, lambda: f"{task.executed_simulations}/{task.total_simulations} simulations"
+    )
+
+    print(task.cur_step)
+    if task.isCanceled():
+        _print_error("Task canceled.")
+        return EXIT_CANCELED
+    if task.exception:
+        _print_error(f"{type(task.exception).__name__}: {task.exception}")
+    return EXIT_OK if result else EXIT_FAILED
+
+
+def run_worker(args):
+    """ Execute the jobs of an Epa Multi Calls batch with option distribute (see core/utils/jobs.py) """
+
+    from .core.utils.jobs import run_worker as run_jobs
+    from .core.utils.process_pool import get_max_workers
+
+    if not os.path.isdir(args.jobs):
+        _print_error(f"Jobs folder not found: {args.jobs}")
+        return EXIT_ARGUMENTS
+    try:
+        max_workers = get_max_workers(args.max_workers, 1) or 1
+    except ValueError:
+        _print_error(f"--max-workers must be an integer or 'auto': {args.max_workers}")
+        return EXIT_ARGUMENTS
+
+    # Bundled EPA executables are in the Giswater plugin folder, if there is one on this machine
+    plugin_dir = args.giswater_dir or settings.get_giswater_folder(get_full_path=True)
+    print(f"Worker started with {max_workers} simulations at the same time: {args.jobs}", flush=True)
+    executed = run_jobs(args.jobs, max_workers, plugin_dir=plugin_dir, engine=args.engine, executable=args.executable,
+                        swmm_library=args.swmm_library, stale_after=args.stale_after,
+                        exit_when_empty=args.exit_when_empty, log=lambda text: print(text, flush=True))
+    print(f"Jobs executed: {executed}")
+    return EXIT_OK
+
+
+def _run_task(task, get_progress):
+    """ Execute task.run in a thread, printing its progress, until it finishes.
+    Ctrl+C cancels the task the same way as the Cancel button of the dialogs """
+
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = task.run()
+        except Exception as e:
+            task.exception = e
+            outcome['result'] = False
+
+    thread = Thread(target=target, name=task.description(), daemon=True)
+    t0 = time()
+    thread.start()
+    last_progress = None
+    while thread.is_alive():
+        try:
+            thread.join(PROGRESS_INTERVAL)
+        except KeyboardInterrupt:
+            print("Canceling...", flush=True)
+            task.cancel()
+            continue
+        progress = get_progress()
+        if thread.is_alive() and progress != last_progress:
+            elapsed = datetime.timedelta(seconds=round(time() - t0))
+            print(f"[{elapsed}] {progress}", flush=True)
+            last_progress = progress
+
+    return outcome.get('result', False)
+
+
+def _read_config(config_file):
+
+    from qgis.PyQt.QtCore import QSettings
+
+    config = QSettings(config_file, QSettings.IniFormat)
+    config.setIniCodec(sys.getfilesystemencoding())
+    return config
+
+
+def _show_plan(args):
+
+    from .core.utils.planner import BatchPlan
+    from .core.utils.scenarios import TRAVERSAL_NESTED, read_levels, read_traversal
+
+    if not os.path.exists(args.config):
+        _print_error(f"Config file not found at: {args.config}")
+        return EXIT_ARGUMENTS
+    config = _read_config(args.config)
+    levels = read_levels(config)
+    if not levels:
+        _print_error(f"There are no lists configured in: {args.config}")
+        return EXIT_ARGUMENTS
+    print(BatchPlan(levels, args.prefix, traversal=read_traversal(config) or TRAVERSAL_NESTED).get_text())
+    return EXIT_OK
+
+
+def _print_error(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def _add_database_args(parser):
+
+    group = parser.add_argument_group("database")
+    group.add_argument("--service", help="PostgreSQL service (pg_service.conf) of the Giswater database")
+    group.add_argument("--host", default="localhost")
+    group.add_argument("--port", default="5432")
+    group.add_argument("--dbname")
+    group.add_argument("--user")
+    group.add_argument("--password", help="defaults to the PGPASSWORD environment variable")
+    group.add_argument("--sslmode", default=None)
+    group.add_argument("--schema", help="schema of the Giswater project")
+
+
+def _parse_args(argv):
+
+    parser = argparse.ArgumentParser(prog="gw_epatools_plugin.cli", description="Run Epa Multi Calls and Additional Demand Check without QGIS")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    multicalls = commands.add_parser("multicalls", help="Epa Multi Calls")
+    multicalls.add_argument("--config", required=True, help="config file with the [options] and [list] sections")
+    multicalls.add_argument("--output", required=True, help="folder of the INP and RPT files")
+    multicalls.add_argument("--prefix", default="", help="prefix of the result names")
+    multicalls.add_argument("--plan", action="store_true",
+                            help="show the scenarios of the batch and exit, without connecting to the database")
+    _add_database_args(multicalls)
+
+    adc = commands.add_parser("adc", help="Additional Demand Check")
+    adc.add_argument("--inp", required=True, help="input INP file")
+    adc.add_argument("--config", required=True, help=".in file with the [OPTIONS] and [JUNCTIONS] sections")
+    adc.add_argument("--output", required=True, help="folder of the result files")
+    adc.add_argument("--name", required=True, help="name of the result files")
+    adc.add_argument("--nodes", choices=("config", "database"), default="config",
+                     help="read the nodes from the [JUNCTIONS] section or from anl_node (fid=491)")
+    adc.add_argument("--save-to-db", action="store_true", help="save the results in anl_node (fid=492)")
+    adc.add_argument("--resume", action="store_true", help="continue from the partial file of a previous execution")
+    adc.add_argument("--overwrite", action="store_true", help="overwrite existing result files")
+    _add_database_args(adc)
+
+    worker = commands.add_parser("worker", help="execute the simulations of Epa Multi Calls batches (option distribute)")
+    worker.add_argument("--jobs", required=True, help="jobs folder of the batch (<output>/<prefix>-jobs)")
+    worker.add_argument("--max-workers", default="1", help="simulations executed at the same time, or 'auto' (one per CPU)")
+    worker.add_argument("--engine", choices=("executable", "toolkit", "auto"),
+                        help="EPA engine, instead of the engine option of the batch")
+    worker.add_argument("--executable", help="EPA command line program of this machine")
+    worker.add_argument("--swmm-library", help="SWMM shared library of this machine")
+    worker.add_argument("--giswater-dir", help="Giswater plugin folder, with the bundled EPA executables")
+    worker.add_argument("--stale-after", type=float,
+                        help="seconds after which a job of a worker that stopped responding is executed again")
+    worker.add_argument("--exit-when-empty", action="store_true", help="exit when there are no pending jobs")
+
+    args = parser.parse_args(argv)
+    if args.command == "worker":
+        return args
+    if args.command == "adc" and args.nodes == "config" and not args.save_to_db:
+        return args
+    if args.command == "multicalls" and args.plan:
+        return args
+    if not args.service and not (args.dbname and args.user):
+        parser.error("a database is required: use --service, or --dbname and --user")
+    if not args.schema:
+        parser.error("--schema is required")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,36 +5,55 @@ General Public License as published by the Free Software Foundation, either vers
 or (at your option) any later version.
 """
 
-import copy
 import csv
 import itertools
 import json
 import math
+import shutil
 import subprocess
-import uuid
+import tempfile
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from threading import Lock, Thread, local
 
 from qgis.core import QgsTask
 
 from .task import GwTask
+from ..utils.autotune import AUTO, get_tuner, get_tuning_file, save_tuned_workers
+from ..utils.demand_check import ENGINE_TOOLKIT, ENGINE_WNTR, PARALLEL_PROCESSES, PARALLEL_THREADS, \
+    SCREENING_OFF, ToolkitSession, get_node_result, get_pairs_within, get_pruned_pairs, init_worker, \
+    is_pair_skipped, simulate_in_worker, simulate_wntr
+from ..utils.epa_engines import SimulationTimeout
+from ..utils.process_pool import create_process_pool
+from ... import global_vars
 from ...settings import tools_db, tools_qgis
 
 WNTR_IMPORT_ERROR = "Couldn't import WNTR Python package. Please check if the Giswater plugin is installed and it has a 'packages' folder in it with 'wntr'. Also note that WNTR only works with Python 3.12 (QGIS >3.34.5)."
 try:
     import wntr
-    from wntr.epanet.util import from_si, to_si, FlowUnits, HydParam
 except ImportError:
     wntr = None
     error_traceback = traceback.format_exc()
     tools_qgis.show_critical(title="Epatools Plugin", text=WNTR_IMPORT_ERROR)
     tools_qgis.show_critical(title="Epatools Plugin", text=error_traceback)
 
+# Result of a check whose simulations exceeded the 'timeout' option
+TIMEOUT = object()
+
 
 class GwAddDemandCheck(GwTask):
     def __init__(
-        self, description, input_file, config, output_folder, file_name, results={}
+        self,
+        description,
+        input_file,
+        config,
+        output_folder,
+        file_name,
+        results={},
+        save_to_db=True,
     ):
         super().__init__(description, QgsTask.CanCancel)
         self.input_file = input_file
@@ -43,18 +62,46 @@ class GwAddDemandCheck(GwTask):
         self.file_name = file_name
         self.partial_file = Path(output_folder) / f"{file_name}-partial.json"
         self.results = results
+        self.save_to_db = save_to_db
         self.accuracy = 0.001
         self.executed_simulations = 0
+        self.timeouts = []
+        self.engine = self.config.options.get("engine", ENGINE_WNTR)
+        self.base_folder = None
+        self.sessions = []
+        self.sessions_lock = Lock()
+        self.worker_data = local()
+        self.parallel = self.config.options.get("parallel", PARALLEL_THREADS)
+        self.process_pool = None
+        self.pool_lock = Lock()
+        self.screening = self.config.options.get("screening", SCREENING_OFF)
+        self.base_pressures = {}
+        self.screened = []
         self.qtd_nodes = len(self.config.junctions)
         self.total_simulations = 2 * self.qtd_nodes + math.comb(self.qtd_nodes, 2)
+        self.tuning_file = get_tuning_file(global_vars.roaming_user_dir, global_vars.user_folder_name)
+        self.tuner = get_tuner(
+            self.config.options.get("max_workers", AUTO),
+            tuning_file=self.tuning_file,
+            key=str(self.input_file),
+        )
 
     def run(self):
-        if not self._execute_check_suite():
-            return False
+        try:
+            if not self._execute_check_suite():
+                return False
+        finally:
+            self._close_sessions()
+        save_tuned_workers(self.tuning_file, str(self.input_file), self.tuner)
+        if self.timeouts:
+            self.cur_step += f"\n\nChecks over time limit: {len(self.timeouts)}"
+        if self.screened:
+            self.cur_step += f"\n\nChecks decided by screening: {len(self.screened)}"
         self.cur_step += "\n\nSaving files..."
         self._save_csv_file()
         self._save_in_file()
-        self._save_results_to_db()
+        if self.save_to_db:
+            self._save_results_to_db()
         self.partial_file.unlink(missing_ok=True)
         return True
 
@@ -63,17 +110,24 @@ class GwAddDemandCheck(GwTask):
         self.cur_step = old_steps + "\n\nChecking individual nodes..."
 
         i = 0
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for node_name, result in executor.map(
+        executor = ThreadPoolExecutor(max_workers=self.tuner.maximum)
+        try:
+            for (node_name, _), result in self._map_checks(
+                executor,
                 self._check_node,
-                self.config.junctions.keys(),
-                self.config.junctions.values(),
+                self.config.junctions.items(),
             ):
                 i += 1
 
                 if self.isCanceled():
                     return False
 
+                if result is TIMEOUT:
+                    result = {"error": "Simulation exceeded the time limit."}
+                    self.timeouts.append(node_name)
+                else:
+                    _, result = result
+
                 self.cur_step = (
                     old_steps
                     + f"\n\nChecking individual nodes ({i}/{self.qtd_nodes})..."
@@ -100,6 +154,10 @@ class GwAddDemandCheck(GwTask):
 
                 if self.executed_simulations % 10 == 0:
                     self._save_partial()
+        except CancelledError:
+            return False
+        finally:
+            self._shutdown_executor(executor)
 
         return True
 
@@ -116,6 +174,27 @@ class GwAddDemandCheck(GwTask):
             self.executed_simulations += 1
             return node_name, {"error": "Node not found in INP file."}
 
+        # Extra demand can't raise the pressure, so both tests would fail
+        if (
+            self.screening != SCREENING_OFF
+            and self.base_pressures[node_name] + self.accuracy < press
+        ):
+            self.executed_simulations += 2
+            self.screened.append(node_name)
+            failed = {
+                "status": "failed",
+                "requiredDemand": dem,
+                "requiredPressure": press,
+                "modelDemand": None,
+                "modelPressure": self.base_pressures[node_name],
+                "screened": True,
+            }
+            return node_name, {
+                "simple": failed,
+                "doubled": dict(failed, requiredDemand=2 * dem),
+                "paired": {"status": None},
+            }
+
         # Run double test fist
         double_demand_node = {
             "name": node_name,
@@ -159,8 +238,8 @@ class GwAddDemandCheck(GwTask):
         node1 = self.config.junctions[node1_name]
         node2 = self.config.junctions[node2_name]
 
-        # Skip pair if already done in previous execution
-        if node2_name in self.results[node1_name]["paired"]:
+        # Skip pair if already done in previous execution or if a node has an error
+        if is_pair_skipped(pair, self.results):
             self.executed_simulations += 1
             return None
 
@@ -175,8 +254,11 @@ class GwAddDemandCheck(GwTask):
         self.cur_step = old_steps + "\n\nChecking node pairs..."
 
         i = 0
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for result in executor.map(self._check_pair, self.pairs):
+        executor = ThreadPoolExecutor(max_workers=self.tuner.maximum)
+        try:
+            for (pair,), result in self._map_checks(
+                executor, self._check_pair, ((pair,) for pair in self.pairs)
+            ):
                 i += 1
                 self.cur_step = (
                     old_steps + f"\n\nChecking node pairs ({i}/{qtd_pairs})..."
@@ -189,6 +271,12 @@ class GwAddDemandCheck(GwTask):
                 if result is None:
                     continue
 
+                if result is TIMEOUT:
+                    self.timeouts.append(pair)
+                    for first, second in itertools.permutations(pair):
+                        self.results[first]["paired"][second] = {"status": "timeout"}
+                    continue
+
                 node1_name, node2_name = result.keys()
 
                 for first, second in itertools.permutations((node1_name, node2_name)):
@@ -199,6 +287,10 @@ class GwAddDemandCheck(GwTask):
                     elif result[first]["status"] == "failed":
                         self.results[first]["paired"]["status"] = "failed"
                     self.results[first]["paired"][second] = result[first]
+        except CancelledError:
+            return False
+        finally:
+            self._shutdown_executor(executor)
 
         return True
 
@@ -223,16 +315,22 @@ class GwAddDemandCheck(GwTask):
         wn.options.hydraulic.demand_multiplier = 1
 
         self.network = wn
-        self.pairs = self._get_initial_pairs()
-        self.total_simulations = 2 * self.qtd_nodes + len(self.pairs)
 
-    def _distance_between(self, p1, p2):
-        x1, y1 = p1["x"], p1["y"]
-        x2, y2 = p2["x"], p2["y"]
-        return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
+        # Toolkit sessions and processes open the prepared network from an INP file
+        if self.engine == ENGINE_TOOLKIT or self.parallel == PARALLEL_PROCESSES:
+            self.base_folder = tempfile.mkdtemp(prefix="adc-")
+            self.base_inp = str(Path(self.base_folder) / "base.inp")
+            wntr.network.write_inpfile(wn, self.base_inp)
+
+        self._set_pairs(self._get_initial_pairs())
+        self.total_simulations = 2 * self.qtd_nodes + len(self.pairs)
 
     def _execute_check_suite(self):
         self._create_network()
+        if self.parallel == PARALLEL_PROCESSES:
+            self.process_pool = self._create_process_pool()
+        if self.screening != SCREENING_OFF:
+            self._simulate_base()
         if not self._check_individual_nodes():
             return False
         if not self._check_pairs():
@@ -240,67 +338,136 @@ class GwAddDemandCheck(GwTask):
         return True
 
     def _execute_individual_check(self, nodes):
-        test_wn = copy.deepcopy(self.network)
-        units = test_wn.options.hydraulic.inpfile_units
-        pat = test_wn.get_pattern("constant_pattern")
-        for node in nodes:
-            junction = test_wn.get_node(node["name"])
-            demand = to_si(FlowUnits[units], node["requiredDemand"], HydParam.Demand)
-            junction.demand_timeseries_list.append((demand, pat))
-
-        prefix = str(Path.home() / ".temp/") + str(uuid.uuid4()).split("-")[0]
-        results = wntr.sim.EpanetSimulator(test_wn).run_sim(file_prefix=prefix).node
+        # Simulations waiting for a worker when the task is canceled don't start
+        if self.isCanceled():
+            raise CancelledError()
+        with self.tuner.slot():
+            if self.isCanceled():
+                raise CancelledError()
+            return self._simulate(nodes)
+
+    def _map_checks(self, executor, function, arguments):
+        """Like executor.map, but yields (args, result) for every tuple of arguments.
+        Checks with a simulation over the 'timeout' option yield (args, TIMEOUT)."""
+        futures = [(args, executor.submit(function, *args)) for args in arguments]
+        for args, future in futures:
+            while True:
+                try:
+                    result = future.result(timeout=0.1)
+                except FuturesTimeoutError:
+                    if self.isCanceled():
+                        raise CancelledError()
+                    continue
+                except SimulationTimeout:
+                    result = TIMEOUT
+                yield args, result
+                break
+
+    def _shutdown_executor(self, executor):
+        # If canceled, drop queued simulations instead of waiting for all of them
+        stop = self.isCanceled()
+        executor.shutdown(wait=not stop, cancel_futures=stop)
+
+    def _simulate_base(self):
+        """Simulate the network without extra demands, to screen the checks"""
+        self.cur_step += "\n\nSimulating base network..."
+        names = set(self.config.junctions) & set(self.network.node_name_list)
+        values = self._get_values({name: 0.0 for name in names})
+        self.base_pressures = {name: pressure for name, (_, pressure) in values.items()}
+
+    def _simulate(self, nodes):
+        demands = {node["name"]: node["requiredDemand"] for node in nodes}
+        values = self._get_values(demands)
+
+        return {
+            node["name"]: get_node_result(node, *values[node["name"]], self.accuracy)
+            for node in nodes
+        }
 
-        test_results = {}
-        for node in nodes:
-            node_extra_demand = (
-                results["demand"][node["name"]][0].item()
-                - self.adjusted_demands[node["name"]]
-            )
-            model_demand = from_si(
-                FlowUnits[units],
-                node_extra_demand,
-                HydParam.Demand,
-            )
-            model_pressure = from_si(
-                FlowUnits[units],
-                results["pressure"][node["name"]][0].item(),
-                HydParam.Pressure,
-            )
-            status = (
-                "ok"
-                if node["requiredDemand"] <= model_demand + self.accuracy
-                and node["requiredPressure"] <= model_pressure + self.accuracy
-                else "failed"
-            )
-            node_result = {
-                "status": status,
-                "requiredDemand": node["requiredDemand"],
-                "requiredPressure": node["requiredPressure"],
-                "modelDemand": model_demand,
-                "modelPressure": model_pressure,
-            }
-            test_results[node["name"]] = node_result
+    def _get_values(self, demands):
+        if self.process_pool is not None:
+            return self._get_values_in_pool(demands)
+        if self.engine == ENGINE_TOOLKIT:
+            return self._get_session().simulate(demands)
+        return simulate_wntr(self.network, self.adjusted_demands, demands)
+
+    def _get_values_in_pool(self, demands):
+        """Simulate in the process pool. A simulation over the 'timeout' option
+        kills the pool and replaces it, so the stuck process doesn't keep running.
+        Simulations of other checks lost with the old pool are submitted again."""
+        timeout = self.config.options.get("timeout")
+        while True:
+            pool = self.process_pool
+            future = pool.submit(simulate_in_worker, demands)
+            try:
+                return future.result(timeout=timeout)
+            except FuturesTimeoutError:
+                self._recycle_process_pool(pool)
+                raise SimulationTimeout(f"Simulation exceeded {timeout} seconds")
+            except BrokenProcessPool:
+                if pool is self.process_pool or self.isCanceled():
+                    raise
+
+    def _create_process_pool(self):
+        # Processes read the prepared network from the base INP file
+        return create_process_pool(
+            self.tuner.maximum,
+            initializer=init_worker,
+            initargs=(self.engine, self.base_inp),
+        )
 
-        return test_results
+    def _recycle_process_pool(self, pool):
+        with self.pool_lock:
+            # Another check may have replaced it already
+            if pool is not self.process_pool:
+                return
+            self.process_pool = self._create_process_pool()
+        _kill_process_pool(pool)
+
+    def _get_session(self):
+        # Every worker thread opens its own session the first time
+        session = getattr(self.worker_data, "session", None)
+        if session is None:
+            session = ToolkitSession(self.base_inp)
+            self.worker_data.session = session
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    def _close_sessions(self):
+        # Canceled simulations may still be running
+        stop = self.isCanceled()
+        if self.process_pool is not None:
+            if stop:
+                _kill_process_pool(self.process_pool)
+            else:
+                self.process_pool.shutdown()
+            self.process_pool = None
+
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, []
+
+        def close():
+            for session in sessions:
+                session.close()
+            if self.base_folder:
+                shutil.rmtree(self.base_folder, ignore_errors=True)
+
+        if stop:
+            Thread(target=close, daemon=True).start()
+        else:
+            close()
 
     def _get_initial_pairs(self):
         """Get initial set of pairs, based on maximum distance"""
-        points = []
+        names = []
+        coordinates = []
         nodes = set(self.config.junctions) & set(self.network.node_name_list)
 
         for node in nodes:
-            x, y = self.network.get_node(node).coordinates
-            points.append({"id": node, "x": x, "y": y})
-
-        pairs = set()
-        while points:
-            p1 = points.pop()
-            for p2 in points:
-                dist = self._distance_between(p1, p2)
-                if dist <= self.config.options["max_distance"]:
-                    pairs.add((p1["id"], p2["id"]))
-        return pairs
+            names.append(node)
+            coordinates.append(self.network.get_node(node).coordinates)
+        return get_pairs_within(names, coordinates, self.config.options["max_distance"])
 
     def _save_csv_file(self):
         file_path = Path(self.output_folder) / f"{self.file_name}.csv"
@@ -338,6 +505,16 @@ class GwAddDemandCheck(GwTask):
         with open(file_path, "w") as infile:
             infile.write("[OPTIONS]\n")
             infile.write(f"max_distance           {o['max_distance']}\n")
+            if "max_workers" in o:
+                infile.write(f"max_workers            {o['max_workers']}\n")
+            if "timeout" in o:
+                infile.write(f"timeout                {o['timeout']}\n")
+            if "engine" in o:
+                infile.write(f"engine                 {o['engine']}\n")
+            if "parallel" in o:
+                infile.write(f"parallel               {o['parallel']}\n")
+            if "screening" in o:
+                infile.write(f"screening              {o['screening']}\n")
             infile.write("\n[JUNCTIONS]\n")
             for node in self.config.junctions.values():
                 name = node["name"]
@@ -391,27 +568,28 @@ class GwAddDemandCheck(GwTask):
         return sql
 
     def _update_pairs(self, node_name):
-        if "error" in self.results[node_name]:
-            return
-        if self.results[node_name]["simple"]["status"] == "failed":
-            to_delete = set()
-            for pair in self.pairs:
-                n1, n2 = pair
-                if node_name == n1 or node_name == n2:
-                    to_delete.add(pair)
-            self.pairs -= to_delete
-        elif self.results[node_name]["doubled"]["status"] == "ok":
-            to_delete = set()
-            for pair in self.pairs:
-                n1, n2 = pair
-                if (
-                    n1 == node_name
-                    and n2 in self.results
-                    and self.results[n2]["doubled"]["status"] == "ok"
-                ) or (
-                    n2 == node_name
-                    and n1 in self.results
-                    and self.results[n1]["doubled"]["status"] == "ok"
-                ):
-                    to_delete.add(pair)
-            self.pairs -= to_delete
+        self._remove_pairs(get_pruned_pairs(node_name, self.results, self.node_pairs))
+
+    def _set_pairs(self, pairs):
+        """Set the candidate pairs and index them by node, so the pairs
+        of a node are found without going through all of them"""
+        self.pairs = pairs
+        self.node_pairs = defaultdict(set)
+        for pair in pairs:
+            for node_name in pair:
+                self.node_pairs[node_name].add(pair)
+
+    def _remove_pairs(self, pairs):
+        for pair in list(pairs):
+            self.pairs.discard(pair)
+            for node_name in pair:
+                self.node_pairs[node_name].discard(pair)
+
+
+def _kill_process_pool(pool):
+    """Stop @pool killing its processes, instead of waiting for their simulations"""
+    # ProcessPoolExecutor has no public method to kill its workers before Python 3.14
+    processes = getattr(pool, "_processes", None) or {}
+    for process in list(processes.values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
@@ -5,20 +5,57 @@ General Public License as published by the Free Software Foundation, either vers
 or (at your option) any later version.
 """
 # -*- coding: utf-8 -*-
+import json
 import os
-import re
-import subprocess
+import queue
 from datetime import timedelta
+from collections import deque
 from time import sleep, time
-from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+from functools import partial
 
 from qgis.PyQt.QtCore import pyqtSignal
 from qgis.PyQt.QtWidgets import QAction
 from qgis.core import QgsApplication, QgsProject, QgsTask
 
 from .task import GwTask
+from ..utils.autotune import get_tuner, get_tuning_file, save_tuned_workers
+from ..utils.epa_engines import EngineError, SimulationTimeout, get_engine
+from ..utils.inp_writer import write_inp_files
+from ..utils.jobs import JobEngine, JobQueue
+from ..utils.manifest import RunManifest, STAGE_EXPORTED, STAGE_IMPORTED, STAGE_SIMULATED
+from ..utils.planner import get_history_file, get_history_key, save_history
+from ..utils.process_pool import create_process_pool, get_max_workers
+from ..utils.result_cache import ResultCache, get_file_hash
+from ..utils.timings import PhaseTimer, timed_call
+from ..utils.scenarios import LIST_QUERIES_PREPARED, LIST_QUERIES_TEXT, TRAVERSAL_GRAY, TRAVERSAL_NESTED, \
+    PreparedQueries, count_scenarios, get_pending_levels, get_result_name, iter_scenarios, read_levels, read_traversal
+from ..utils.rpt_parser import RptParseError, get_rpt_sources, iter_rpt_rows, parse_rpt_file, row_to_json, \
+    COPY_TABLE, CopyStream, get_copy_json_sql, get_copy_sql, get_copy_table_sql, iter_copy_lines, write_copy_file
 from ... import global_vars
-from ...settings import tools_qgis, tools_qt, tools_gw, tools_db, tools_os, tools_log, task, get_giswater_folder
+from ...settings import tools_qgis, tools_qt, tools_gw, tools_db, tools_os, tools_log, task, get_giswater_folder, \
+    gw_global_vars, lib_vars
+
+
+COPY_BUFFER_SIZE = 1024 * 1024
+PG2EPA_STEPS = 'steps'
+PG2EPA_BATCH = 'batch'
+# Step of gw_fct_pg2epa_main whose result has the INP file
+PG2EPA_RESULT_STEP = 6
+INP_EXPORT_JSON = 'json'
+INP_EXPORT_CURSOR = 'cursor'
+INP_CHUNK_SIZE = 5000
+# Default maximum of simulations submitted to the jobs folder at the same time (options/max_jobs)
+MAX_JOBS = 100
+
+
+class ExportError(Exception):
+    """ Raised by an export session when gw_fct_pg2epa_main fails """
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
 
 
 class GwRecursiveEpa(task.GwTask):
@@ -39,6 +76,20 @@ class GwRecursiveEpa(task.GwTask):
         self.total_objects = 0
         self.file_pairs = []
         self.max_threads = 4
+        self.rpt_sources = None
+        self.timer = None
+        self.manifest = None
+        self.cur_idx = 0
+        self.resumed_count = 0
+        self.timeouts = []
+        self.job_queue = None
+        self.max_jobs = MAX_JOBS
+        self.prepared_queries = None
+        self.list_conn = None
+        self.history_key = get_history_key(QgsProject.instance().fileName(), settings.fileName())
+        self.export_roles = []
+        self.export_sessions = []
+        self.export_stopped = False
         self.initialize_variables()
 
 
@@ -61,22 +112,69 @@ class GwRecursiveEpa(task.GwTask):
 
         self.change_btn_accept.emit(True)
         self.export_subcatch = self.settings.value("options/export_subcatch")
-        max_threads = self.settings.value("options/max_threads")
+        self.pg2epa_mode = (self.settings.value("options/pg2epa") or PG2EPA_STEPS).lower()
+        if self.pg2epa_mode not in (PG2EPA_STEPS, PG2EPA_BATCH):
+            tools_log.log_warning(f"Unknown pg2epa '{self.pg2epa_mode}'. Using '{PG2EPA_STEPS}'.")
+            self.pg2epa_mode = PG2EPA_STEPS
+        self.inp_export = (self.settings.value("options/inp_export") or INP_EXPORT_JSON).lower()
+        if self.inp_export not in (INP_EXPORT_JSON, INP_EXPORT_CURSOR):
+            tools_log.log_warning(f"Unknown inp_export '{self.inp_export}'. Using '{INP_EXPORT_JSON}'.")
+            self.inp_export = INP_EXPORT_JSON
+        inp_chunk_size = self.settings.value("options/inp_chunk_size")
         try:
-            self.max_threads = int(max_threads)
+            self.inp_chunk_size = int(inp_chunk_size) if inp_chunk_size else INP_CHUNK_SIZE
         except ValueError:
-            msg = f"Tried to set max_threads to '{max_threads}' but it's not an integer. Defaulting to 4 threads."
+            msg = f"Tried to set inp_chunk_size to '{inp_chunk_size}' but it's not an integer. Defaulting to {INP_CHUNK_SIZE} rows."
             tools_log.log_warning(msg)
-
-        # Get queries and lists
-        lists1, lists2, lists3, queries1, queries2, queries3 = self._get_queries_and_lists()
-
-        # Calculate total number of objects in all lists
-        self.total_objects = len([item for sublist in lists1 for item in sublist])
-        if lists2:
-            self.total_objects *= len([item for sublist in lists2 for item in sublist])
-        if lists3:
-            self.total_objects *= len([item for sublist in lists3 for item in sublist])
+            self.inp_chunk_size = INP_CHUNK_SIZE
+        max_threads = self.settings.value("options/max_threads")
+        self.tuning_file = get_tuning_file(global_vars.roaming_user_dir, global_vars.user_folder_name)
+        try:
+            self.tuner = get_tuner(max_threads, self.max_threads, self.tuning_file, self.settings.fileName())
+        except (TypeError, ValueError):
+            msg = f"Tried to set max_threads to '{max_threads}' but it's not an integer or 'auto'. Defaulting to 4 threads."
+            tools_log.log_warning(msg)
+            self.tuner = get_tuner(self.max_threads)
+        self.max_threads = self.tuner.maximum
+        export_roles = self.settings.value("options/export_roles") or []
+        if not issubclass(type(export_roles), list):
+            export_roles = export_roles.split(',')
+        self.export_roles = [role.strip() for role in export_roles if role.strip()]
+
+        # Get levels ([list1], [list2]...) of scenarios
+        levels = read_levels(self.settings)
+        traversal = read_traversal(self.settings)
+        if traversal is None:
+            tools_log.log_warning(f"Unknown traversal '{self.settings.value('options/traversal')}'. Using '{TRAVERSAL_NESTED}'.")
+            traversal = TRAVERSAL_NESTED
+        list_queries = (self.settings.value("options/list_queries") or LIST_QUERIES_TEXT).lower()
+        if list_queries not in (LIST_QUERIES_TEXT, LIST_QUERIES_PREPARED):
+            tools_log.log_warning(f"Unknown list_queries '{list_queries}'. Using '{LIST_QUERIES_TEXT}'.")
+            list_queries = LIST_QUERIES_TEXT
+        if list_queries == LIST_QUERIES_PREPARED:
+            self.prepared_queries = PreparedQueries(levels)
+            unprepared = self.prepared_queries.get_unprepared()
+            if unprepared:
+                tools_log.log_warning(f"These queries can't be prepared and are executed as text: {', '.join(unprepared)}")
+
+        # Calculate total number of scenarios
+        self.total_objects = count_scenarios(levels)
+
+        # Duration of every phase of every scenario
+        self.timer = PhaseTimer(os.path.join(self.path, f"{self.prefix}-timings.jsonl"))
+
+        # Stages completed by every scenario, to resume the batch if it is interrupted
+        resume = str(self.settings.value("options/resume")).lower() in ('true', 'yes', '1')
+        self.manifest = RunManifest(os.path.join(self.path, f"{self.prefix}-manifest.jsonl"),
+                                    get_file_hash(self.settings.fileName()), resume)
+        if resume and not self.manifest.resumed:
+            tools_log.log_info(f"There is no batch to resume with this config file. Starting a new one.")
+
+        # Simulations and imports run while the following scenarios are being exported
+        if not self.execute_multi_epa():
+            self._close_timer()
+            self.manifest.close()
+            return False
 
         # ================================
         # Execute fct_pg2epa_main
@@ -84,114 +182,137 @@ class GwRecursiveEpa(task.GwTask):
         try:
             self.t0 = time()  # Initial time
             self.cur_idx = 0
-            # For each query in `list1` section
-            for idx1, query1 in enumerate(queries1):  # Get the `query{i}` parameter (`list1` section)
-                list1 = lists1[idx1]  # Get the `list{i}` parameter (`list1` section)
-                # For each object in the `list{i}` parameter (`list1` section)
-                for l1o in list1:
-                    query = query1.replace("$list1object", l1o)  # Replace `$list1object` for actual `list{i}` object
-                    tools_db.execute_sql(query, is_thread=True)  # Execute `query{i}` from `list1` section
-                    if self.stop or global_vars.session_vars['last_error']:
-                        return False
-                    if not queries2 or not lists2:
-                        self.run_go2epa(l1o)
-                        continue
-                    # Process `list2` section
-                    for idx2, query2 in enumerate(queries2):  # Get the `query{i}` parameter (`list2` section)
-                        list2 = lists2[idx2]  # Get the `list{i}` parameter (`list2` section)
-                        # For each object in the `list{i}` parameter (`list2` section)
-                        for l2o in list2:
-                            query = query2.replace("$list2object", l2o)  # Replace `$list2object` for actual `list{i}` object
-                            tools_db.execute_sql(query, is_thread=True)  # Execute `query{i}` from `list2` section
-                            if self.stop or global_vars.session_vars['last_error']:
-                                return False
-                            if not queries3 or not lists3:
-                                self.run_go2epa(l1o, l2o)
-                                continue
-                            # Process `list3` section
-                            for idx3, query3 in enumerate(queries3):  # Get the `query{i}` parameter (`list3` section)
-                                list3 = lists3[idx3]  # Execute `query{i}` from `list3` section
-                                # For each object in the `list{i}` parameter (`list2` section)
-                                for l3o in list3:
-                                    query = query3.replace("$list3object", l3o)  # Replace `$list3object` for actual `list{i}` object
-                                    tools_db.execute_sql(query, is_thread=True)  # Execute `query{i}` from `list3` section
-                                    self.run_go2epa(l1o, l2o, l3o)
-                                    if self.stop or global_vars.session_vars['last_error']:
-                                        return False
+            if self.export_roles:
+                status = self._export_parallel(levels, traversal)
+            else:
+                status = self._export_serial(levels, traversal)
+            if not status:
+                return False
 
+            # ================================
+            # Wait for pending epa executions & import rpt(s)
+            # ================================
+            self.import_rpt(wait=True)
         except Exception as e:
             self.exception = e
             return False
+        finally:
+            self._shutdown_multi_epa()
+            self._close_timer()
+            self.manifest.close()
+            if self.list_conn is not None:
+                self._close_export_session(self.list_conn)
+                self.list_conn = None
 
-        # ================================
-        # Execute epa software & import rpt(s)
-        # ================================
+        return True
+
+
+    def _export_serial(self, levels, traversal):
+
+        applied = [None] * len(levels)  # State currently applied on every level
+        for states, _ in iter_scenarios(levels, traversal):
+            values = [level.get_value(state) for level, state in zip(levels, states)]
+            resultname = get_result_name(self.prefix, values)
+
+            # Scenarios exported by a previous execution don't need their lists to be applied
+            stage = self._get_resume_stage(resultname)
+            if stage is not None:
+                self._add_scenario(resultname, *self._get_file_names(resultname), stage)
+                continue
+
+            # Execute `query{i}` only for the levels whose value changes
+            for level_idx in get_pending_levels(applied, states, traversal):
+                level = levels[level_idx]
+                state = states[level_idx]
+                previous = applied[level_idx]
+                applied[level_idx] = state
+                if traversal == TRAVERSAL_GRAY and previous is not None and level.states[previous] == level.states[state]:
+                    continue
+                with self.timer.measure(resultname, "list_query", level=level.number):
+                    if not self._execute_list_query(level, state):
+                        return False
+                if self.stop or global_vars.session_vars['last_error']:
+                    return False
+            self.run_go2epa(*values)
+            if self.stop or global_vars.session_vars['last_error']:
+                return False
+
+        return True
+
+
+    def _execute_list_query(self, level, state):
+        """ Set @level to @state, executing its query as a prepared statement with option list_queries=prepared """
+
+        if self.prepared_queries is None:
+            tools_db.execute_sql(level.get_query(state), is_thread=True)
+            return True
+
+        conn = self._get_list_conn()
         try:
-            self.execute_multi_epa()
-            self.import_rpt()
+            with conn.cursor() as cursor:
+                self.prepared_queries.execute(cursor, level, state)
+            conn.commit()
         except Exception as e:
-            self.exception = e
+            conn.rollback()
+            self.error_msg = f"Query of [list{level.number}] failed for value '{level.get_value(state)}': {e}"
             return False
-
         return True
 
 
-    def _get_queries_and_lists(self):
-        # list1
-        queries1 = []
-        lists1 = []
-        for i in range(1, 20):
-            query = self.settings.value(f"list1/query{i}")
-            list_str = self.settings.value(f"list1/list{i}")
-            if not query or not list_str:
-                break
-            queries1.append(query)
-            if not issubclass(type(list_str), list):
-                list_str = [list_str]
-            lists1.append(list_str)
-        # list2
-        queries2 = []
-        lists2 = []
-        for i in range(1, 20):
-            query = self.settings.value(f"list2/query{i}")
-            list_str = self.settings.value(f"list2/list{i}")
-            if not query or not list_str:
-                break
-            queries2.append(query)
-            if not issubclass(type(list_str), list):
-                list_str = [list_str]
-            lists2.append(list_str)
-        # list3
-        queries3 = []
-        lists3 = []
-        for i in range(1, 20):
-            query = self.settings.value(f"list3/query{i}")
-            list_str = self.settings.value(f"list3/list{i}")
-            if not query or not list_str:
-                break
-            queries3.append(query)
-            if not issubclass(type(list_str), list):
-                list_str = [list_str]
-            lists3.append(list_str)
-        return lists1, lists2, lists3, queries1, queries2, queries3
+    def _get_list_conn(self):
+        """ Connection of the prepared list queries. In steps mode the connection of tools_db is reset after every
+        scenario, which would drop the prepared statements, so they get their own connection for the whole batch """
+
+        if self.pg2epa_mode != PG2EPA_STEPS:
+            # Same connection as tools_db.execute_sql
+            return tools_db.dao.conn
+        if self.list_conn is None:
+            search_path = self._get_search_path()
+            conn = tools_db.dao.get_aux_conn()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"SET search_path TO {search_path}")
+                conn.commit()
+            except Exception:
+                self._close_export_session(conn)
+                raise
+            self.list_conn = conn
+        return self.list_conn
+
+
+    def run_go2epa(self, *values):
+        """ Export the current scenario. @values are the objects of every list, from the outermost level """
+        resultname = get_result_name(self.prefix, values)
+        inpfilename, rptfilename = self._get_file_names(resultname)
+        if self.execute_go2epa(resultname, inpfilename, rptfilename):
+            self.manifest.mark_exported(resultname, inpfilename)
+        self._add_scenario(resultname, inpfilename, rptfilename)
+        self._calculate_remaining_time()
+
+
+    def _add_scenario(self, resultname, inpfilename, rptfilename, stage=STAGE_EXPORTED):
+        """ Submit the INP file of a scenario to EPA. @stage is the last stage completed by the scenario,
+        lower than STAGE_EXPORTED only when it has been resumed from a previous execution """
 
-
-    def run_go2epa(self, l1o=None, l2o=None, l3o=None):
         self.cur_idx += 1
-        resultname = f"{self.prefix}"
-        if l3o:
-            resultname += f"-{l3o}"
-        if l2o:
-            resultname += f"-{l2o}"
-        if l1o:
-            resultname += f"-{l1o}"
         self.files_exported.append(resultname)
-        inpfilename = f"{self.path}{os.sep}{resultname}.inp"
-        rptfilename = f"{self.path}{os.sep}{resultname}.rpt"
-        self.execute_go2epa(resultname, inpfilename, rptfilename)
         self.file_pairs.append((resultname, inpfilename, rptfilename))
-        self._calculate_remaining_time(self.t0)
-        self.t0 = time()
+        if stage != STAGE_EXPORTED:
+            self.resumed_count += 1
+        if stage != STAGE_IMPORTED:
+            self._submit_epa(resultname, inpfilename, rptfilename, simulated=stage == STAGE_SIMULATED)
+
+
+    def _get_file_names(self, resultname):
+        return f"{self.path}{os.sep}{resultname}.inp", f"{self.path}{os.sep}{resultname}.rpt"
+
+
+    def _get_resume_stage(self, resultname):
+        """ Last stage completed by @resultname in the execution being resumed (None if it has to be exported) """
+
+        if not self.manifest.resumed:
+            return None
+        return self.manifest.get_resume_stage(resultname, *self._get_file_names(resultname))
 
     def finished(self, result):
 
@@ -239,37 +360,272 @@ class GwRecursiveEpa(task.GwTask):
 
 
     def cancel(self):
-        self.stop_task()
+        self._stop_running()
+        # Also when the task had already stopped by itself (e.g. after an error)
         super().cancel()
 
 
     def stop_task(self):
+        self.cancel()
+
+
+    def _stop_running(self):
+        """ Stop the task at once: queued simulations are discarded, running ones are killed
+        and running database statements are canceled """
+
+        if self.stop:
+            return
         self.stop = True
+        engine = getattr(self, 'engine', None)
+        if engine is not None:
+            engine.cancel()
+        for conn in [getattr(self, 'aux_conn', None), self.list_conn] + self.export_sessions:
+            if conn is None:
+                continue
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+
 
+    def _calculate_remaining_time(self):
+        """ Remaining time from the mean time of the scenarios simulated by this execution. Scenarios resumed
+        from a previous execution and results from the cache take almost no time, so they aren't counted """
 
-    def _calculate_remaining_time(self, t0):
-        tf = time()  # Final time
-        td = tf - t0  # Delta time
-        print(f"{td} * ({self.total_objects} - {self.cur_idx})")
-        print(td * (self.total_objects - self.cur_idx))
-        time_remaining = td * (self.total_objects - self.cur_idx)  # Delta time * remaining pages
+        cached = self.result_cache.hits if self.result_cache is not None else 0
+        simulated = self.cur_idx - self.resumed_count - cached
+        if simulated <= 0:
+            return
+        td = time() - self.t0  # Delta time since the batch started
+        time_remaining = td / simulated * (self.total_objects - self.cur_idx)
         self.time_changed.emit(f"Remaining: {timedelta(seconds=round(time_remaining))} ({self.cur_idx}/{self.total_objects})")
 
 
     def execute_go2epa(self, resultname, inpfilename, rptfilename):
 
         # Execute pg2epa
-        status = self._exec_function_pg2epa(resultname)
-        tools_db.dao.reset_db()
+        stream = self.inp_export == INP_EXPORT_CURSOR
+        if self.pg2epa_mode == PG2EPA_BATCH or stream:
+            # The same connection is kept for the whole batch. When streaming, the INP file is written here
+            status = self._exec_conn_pg2epa(resultname, *((inpfilename, rptfilename) if stream else ()))
+        else:
+            status = self._exec_function_pg2epa(resultname)
+        if self.pg2epa_mode == PG2EPA_STEPS:
+            tools_db.dao.reset_db()
         if not status:
             self.function_name = 'gw_fct_pg2epa_main'
             return False
+        if stream:
+            return True
 
         # Export inp
-        status = self._export_inp(inpfilename, rptfilename)
+        with self.timer.measure(resultname, "inp_write") as extra:
+            status = self._export_inp(inpfilename, rptfilename)
+            if status and os.path.exists(inpfilename):
+                extra['bytes'] = os.path.getsize(inpfilename)
 
         return status
 
+    # region parallel export
+    def _export_parallel(self, levels, traversal):
+        """ Export scenarios through one database session per role of option 'export_roles'.
+        Every session takes the next scenario, sets its lists and executes gw_fct_pg2epa_main on its own, so the
+        selectors of one role aren't changed by the others. This task submits the INP files to EPA and imports
+        the RPT files as they arrive, as in the serial export.
+        """
+
+        sessions = []
+        try:
+            for role in self.export_roles:
+                sessions.append(self._open_export_session(role))
+        except Exception as e:
+            for conn in sessions:
+                self._close_export_session(conn)
+            self.error_msg = f"Couldn't open export session: {e}"
+            return False
+        tools_log.log_info(f"Exporting scenarios through {len(sessions)} sessions: {', '.join(self.export_roles)}")
+        self.export_sessions = sessions
+
+        self.export_stopped = False
+        scenarios = iter_scenarios(levels, traversal)
+        scenarios_lock = Lock()
+        exported = queue.Queue(maxsize=self.max_backlog)
+        executor = ThreadPoolExecutor(max_workers=len(sessions))
+        for conn in sessions:
+            executor.submit(self._export_session_worker, conn, levels, traversal, scenarios, scenarios_lock, exported)
+
+        try:
+            running = len(sessions)
+            while running:
+                try:
+                    item = exported.get(timeout=0.1)
+                except queue.Empty:
+                    self.import_rpt()
+                    if self.stop:
+                        return False
+                    continue
+
+                if item is None:
+                    running -= 1
+                elif isinstance(item, ExportError):
+                    self.function_name = 'gw_fct_pg2epa_main'
+                    self.function_failed = True
+                    self.complet_result = item.result
+                    tools_log.log_warning(str(item))
+                    return False
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    resultname, inpfilename, rptfilename, result, stage = item
+                    self._add_scenario(resultname, inpfilename, rptfilename, stage)
+                    if result is not None:
+                        self.complet_result = result
+                        self.message = result.get('message', {}).get('text')
+                        self._calculate_remaining_time()
+                if self.stop or self.error_msg:
+                    return False
+        finally:
+            self.export_stopped = True
+            executor.shutdown(wait=True)
+            self.export_sessions = []
+            for conn in sessions:
+                self._close_export_session(conn)
+
+        self.common_msg += "Export INP finished. "
+        return True
+
+
+    def _export_session_worker(self, conn, levels, traversal, scenarios, scenarios_lock, exported):
+
+        applied = [None] * len(levels)  # State applied on every level of this session
+        try:
+            while not self.export_stopped and not self.stop:
+                with scenarios_lock:
+                    states, _ = next(scenarios, (None, None))
+                if states is None:
+                    break
+
+                values = [level.get_value(state) for level, state in zip(levels, states)]
+                resultname = get_result_name(self.prefix, values)
+                inpfilename, rptfilename = self._get_file_names(resultname)
+
+                stage = self._get_resume_stage(resultname)
+                if stage is not None:
+                    self._put_exported(exported, (resultname, inpfilename, rptfilename, None, stage))
+                    continue
+
+                cursor = conn.cursor()
+                try:
+                    for level_idx in get_pending_levels(applied, states, traversal):
+                        level = levels[level_idx]
+                        with self.timer.measure(resultname, "list_query", level=level.number):
+                            if self.prepared_queries is not None:
+                                self.prepared_queries.execute(cursor, level, states[level_idx])
+                            else:
+                                cursor.execute(level.get_query(states[level_idx]))
+                            conn.commit()
+                        applied[level_idx] = states[level_idx]
+                    cursor.execute("SELECT value FROM config_param_user "
+                                   "WHERE parameter = 'inp_options_networkmode' AND cur_user = current_user")
+                    networkmode = cursor.fetchone()
+                    conn.commit()
+                finally:
+                    cursor.close()
+
+                stream = self.inp_export == INP_EXPORT_CURSOR
+                gul_path = self._get_gul_path(inpfilename, networkmode)
+                result, written = self._fetch_pg2epa(conn, resultname, inpfilename if stream else None, gul_path)
+                if not result or result.get('status', 'Failed') == 'Failed' or \
+                        not (written if stream else 'file' in result.get('body', {})):
+                    raise ExportError(f"gw_fct_pg2epa_main failed for result '{resultname}'", result)
+
+                if not stream:
+                    with self.timer.measure(resultname, "inp_write") as extra:
+                        write_inp_files((row.get('text') for row in result['body'].pop('file')), inpfilename,
+                                        gul_path)
+                        extra['bytes'] = os.path.getsize(inpfilename)
+                self.manifest.mark_exported(resultname, inpfilename)
+                self._put_exported(exported, (resultname, inpfilename, rptfilename, result, STAGE_EXPORTED))
+        except Exception as e:
+            conn.rollback()
+            self._put_exported(exported, e)
+        finally:
+            self._put_exported(exported, None)
+
+
+    def _put_exported(self, exported, item):
+        """ Wait for room in the queue of exported scenarios unless the export has finished """
+
+        while not self.export_stopped:
+            try:
+                exported.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+    def _open_export_session(self, role):
+        """ New connection that acts as @role, with the search_path of the task connection
+        and the selectors and user settings of the user """
+
+        search_path = self._get_search_path()
+        conn = tools_db.dao.get_aux_conn()
+        cursor = conn.cursor()
+        try:
+            self._copy_user_state(cursor, role)
+            cursor.execute("SET ROLE %s", (role,))
+            cursor.execute(f"SET search_path TO {search_path}")
+            conn.commit()
+        except Exception:
+            self._close_export_session(conn)
+            raise
+        finally:
+            cursor.close()
+        return conn
+
+
+    def _copy_user_state(self, cursor, role):
+        """ Replace the rows of @role in the selector tables and config_param_user with the ones of the user,
+        so the scenarios exported as @role use the same selectors and settings as the serial export """
+
+        schema_name = self._get_schema_name()
+        cursor.execute(
+            "SELECT c.table_name, array_agg(c.column_name::text ORDER BY c.ordinal_position) "
+            "FROM information_schema.columns c "
+            "JOIN information_schema.tables t USING (table_schema, table_name) "
+            "WHERE c.table_schema = COALESCE(%s, current_schema()) AND t.table_type = 'BASE TABLE' "
+            "AND (c.table_name LIKE 'selector\\_%%' OR c.table_name = 'config_param_user') "
+            "AND c.is_identity = 'NO' AND COALESCE(c.column_default, '') NOT LIKE 'nextval(%%' "
+            "GROUP BY c.table_name HAVING bool_or(c.column_name = 'cur_user')",
+            (schema_name,))
+        for table_name, columns in cursor.fetchall():
+            table = _quote_ident(table_name) if schema_name is None else \
+                f"{_quote_ident(schema_name)}.{_quote_ident(table_name)}"
+            names = ", ".join(_quote_ident(column) for column in columns)
+            values = ", ".join("%(role)s" if column == 'cur_user' else _quote_ident(column) for column in columns)
+            cursor.execute(f"DELETE FROM {table} WHERE cur_user = %(role)s", {'role': role})
+            cursor.execute(f"INSERT INTO {table} ({names}) SELECT {values} FROM {table} WHERE cur_user = current_user",
+                           {'role': role})
+
+
+    def _get_search_path(self):
+
+        cursor = self._get_task_conn().cursor()
+        try:
+            cursor.execute("SHOW search_path")
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+
+    def _close_export_session(self, conn):
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+    # endregion
+
     # region pg2epa
     def _exec_function_pg2epa(self, resultname):
 
@@ -285,9 +641,10 @@ class GwRecursiveEpa(task.GwTask):
             self.body = tools_gw.create_body(extras=extras + f', "step": {i}')
             tools_log.log_info(f"Task 'Go2Epa' execute procedure 'gw_fct_pg2epa_main' step {i} with parameters: "
                                f"'gw_fct_pg2epa_main', '{self.body}', 'log_sql=True', 'aux_conn={self.aux_conn}', 'is_thread=True'")
-            json_result = tools_gw.execute_procedure('gw_fct_pg2epa_main', self.body, log_sql=True,
-                                                     aux_conn=self.aux_conn, is_thread=True)
-            if i == 6:
+            with self.timer.measure(resultname, f"pg2epa_step{i}"):
+                json_result = tools_gw.execute_procedure('gw_fct_pg2epa_main', self.body, log_sql=True,
+                                                         aux_conn=self.aux_conn, is_thread=True)
+            if i == PG2EPA_RESULT_STEP:
                 self.json_result = json_result
                 self.complet_result = json_result
             if self.isCanceled():
@@ -306,6 +663,167 @@ class GwRecursiveEpa(task.GwTask):
             return False
 
         return status
+
+
+    def _exec_conn_pg2epa(self, resultname, inpfilename=None, rptfilename=None):
+        """ Execute gw_fct_pg2epa_main through the task connection (batch mode or INP streaming).
+        :param inpfilename: if set, INP rows are read with a server-side cursor and written into this file
+        """
+
+        self.json_result = None
+        self.complet_result = None
+        self.setProgress(0)
+
+        gul_path = None
+        if inpfilename is not None:
+            self.file_inp = inpfilename
+            self.file_rpt = rptfilename
+            networkmode = tools_gw.get_config_value('inp_options_networkmode')
+            gul_path = self._get_gul_path(inpfilename, networkmode)
+
+        tools_log.log_info(f"Task 'Go2Epa' execute procedure 'gw_fct_pg2epa_main' ({self.pg2epa_mode}) "
+                           f"for result '{resultname}'")
+        try:
+            self.json_result, written = self._fetch_pg2epa(self._get_task_conn(), resultname, inpfilename, gul_path)
+        except Exception as e:
+            tools_log.log_warning(f"gw_fct_pg2epa_main failed: {e}")
+            self.function_failed = True
+            self.error_msg = str(e)
+            return False
+        self.complet_result = self.json_result
+        if self.isCanceled():
+            return False
+
+        # Manage json result
+        if self.json_result is None or not self.json_result:
+            self.function_failed = True
+            return False
+        if self.json_result.get('status') == 'Failed':
+            tools_log.log_warning(self.json_result)
+            self.function_failed = True
+            return False
+        if 'status' not in self.json_result:
+            return False
+
+        if inpfilename is not None:
+            if not written:
+                return False
+            self.message = self.json_result['message']['text']
+            self.common_msg += "Export INP finished. "
+
+        return True
+
+
+    def _get_pg2epa_bodies(self, resultname):
+        """ Bodies of steps 1 to 7 of gw_fct_pg2epa_main """
+
+        extras = f'"resultId":"{resultname}"'
+        if global_vars.project_type == 'ud':
+            extras += f', "dumpSubcatch":"{self.export_subcatch}"'
+        return [tools_gw.create_body(extras=extras + f', "step": {i}') for i in range(1, 8)]
+
+
+    def _fetch_pg2epa(self, conn, resultname, inp_path=None, gul_path=None):
+        """ Execute gw_fct_pg2epa_main on @conn and return (result of step 6, True if the INP has been written).
+        In batch mode all steps are sent at once: the result of step 6 is kept in a temporary table
+        until step 7 has been executed.
+        :param inp_path: if set, the INP rows aren't returned inside the result: they are read with a server-side
+            cursor, inp_chunk_size rows at a time, and written into @inp_path (and @gul_path)
+        """
+
+        stream = inp_path is not None
+        batch = self.pg2epa_mode == PG2EPA_BATCH
+        bodies = self._get_pg2epa_bodies(resultname)
+        function_name = self._get_qualified_name('gw_fct_pg2epa_main')
+
+        def step_sql(i, body):
+            if i == PG2EPA_RESULT_STEP and (batch or stream):
+                cast = "::jsonb" if stream else ""
+                return f"CREATE TEMP TABLE temp_pg2epa_result ON COMMIT DROP AS " \
+                       f"SELECT {function_name}({body}){cast} AS result;\n"
+            return f"SELECT {function_name}({body});\n"
+
+        if stream:
+            result_sql = "SELECT result #- '{body,file}', result->'body' ? 'file' FROM temp_pg2epa_result;"
+        else:
+            result_sql = "SELECT result FROM temp_pg2epa_result;"
+
+        row = None
+        written = False
+        autocommit = conn.autocommit
+        cursor = conn.cursor()
+        try:
+            if stream and autocommit:
+                # The temporary table and the server-side cursor only live inside a transaction
+                conn.autocommit = False
+            if batch:
+                sql = "".join(step_sql(i, body) for i, body in enumerate(bodies, start=1)) + result_sql
+                with self.timer.measure(resultname, "pg2epa_batch"):
+                    cursor.execute(sql)
+                    row = cursor.fetchone()
+            else:
+                for i, body in enumerate(bodies, start=1):
+                    with self.timer.measure(resultname, f"pg2epa_step{i}"):
+                        cursor.execute(step_sql(i, body))
+                        if i == PG2EPA_RESULT_STEP and not stream:
+                            row = cursor.fetchone()
+                        if not stream or i < PG2EPA_RESULT_STEP:
+                            conn.commit()
+                if stream:
+                    cursor.execute(result_sql)
+                    row = cursor.fetchone()
+
+            result = row[0] if row else None
+            if isinstance(result, str):
+                result = json.loads(result)
+            if stream and result and result.get('status', 'Failed') != 'Failed' and row[1]:
+                with self.timer.measure(resultname, "inp_write", streamed=True) as extra:
+                    self._stream_inp_rows(conn, inp_path, gul_path)
+                    extra['bytes'] = os.path.getsize(inp_path)
+                written = True
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            if conn.autocommit != autocommit:
+                conn.autocommit = autocommit
+
+        return result, written
+
+
+    def _get_qualified_name(self, function_name):
+        """ @function_name in the schema of the project, as tools_gw.execute_procedure calls it,
+        so it doesn't depend on the search_path of the connection """
+
+        schema_name = self._get_schema_name()
+        if schema_name is None:
+            return function_name
+        return f"{_quote_ident(schema_name)}.{function_name}"
+
+
+    def _get_schema_name(self):
+
+        for module in (lib_vars, gw_global_vars, global_vars):
+            schema_name = getattr(module, 'schema_name', None)
+            if schema_name:
+                return schema_name
+        return None
+
+
+    def _stream_inp_rows(self, conn, inp_path, gul_path):
+        """ Write the INP rows kept in temp_pg2epa_result, fetching them in chunks with a server-side cursor """
+
+        cursor = conn.cursor(name="pg2epa_inp_rows")
+        cursor.itersize = self.inp_chunk_size
+        try:
+            cursor.execute("SELECT t.elem->>'text' FROM temp_pg2epa_result, "
+                           "jsonb_array_elements(result->'body'->'file') WITH ORDINALITY AS t(elem, idx) "
+                           "ORDER BY t.idx")
+            write_inp_files((row[0] for row in cursor), inp_path, gul_path)
+        finally:
+            cursor.close()
     # endregion
 
     # region export inp
@@ -338,50 +856,16 @@ class GwRecursiveEpa(task.GwTask):
 
         tools_log.log_info(f"Write inp file........: {folder_path}")
 
-        # Generate generic INP file
-        file_inp = open(folder_path, "w")
-        read = True
-        for row in all_rows:
-            # Use regexp to check which targets to read (everyone except GULLY)
-            if bool(re.match('\[(.*?)\]', row['text'])) and \
-                    ('GULLY' in row['text'] or 'LINK' in row['text'] or
-                     'GRATE' in row['text'] or 'LXSECTIONS' in row['text']):
-                read = False
-            elif bool(re.match('\[(.*?)\]', row['text'])):
-                read = True
-            if 'text' in row and row['text'] is not None and read:
-                line = row['text'].rstrip() + "\n"
-                file_inp.write(line)
-
-        self._close_file(file_inp)
-
         networkmode = tools_gw.get_config_value('inp_options_networkmode')
-        if global_vars.project_type == 'ud' and networkmode and networkmode[0] == "2":
+        write_inp_files((row.get('text') for row in all_rows), folder_path, self._get_gul_path(folder_path, networkmode))
 
-            # Replace extension .inp
-            aditional_path = folder_path.replace('.inp', f'.gul')
-            aditional_file = open(aditional_path, "w")
-            read = True
-            save_file = False
-            for row in all_rows:
-                # Use regexp to check which targets to read (only TITLE and aditional target)
-                if bool(re.match('\[(.*?)\]', row['text'])) and \
-                        ('TITLE' in row['text'] or 'GULLY' in row['text'] or 'LINK' in row['text'] or
-                         'GRATE' in row['text'] or 'LXSECTIONS' in row['text']):
-                    read = True
-                    if 'GULLY' in row['text'] or 'LINK' in row['text'] or \
-                       'GRATE' in row['text'] or 'LXSECTIONS' in row['text']:
-                        save_file = True
-                elif bool(re.match('\[(.*?)\]', row['text'])):
-                    read = False
-                if 'text' in row and row['text'] is not None and read:
-                    line = row['text'].rstrip() + "\n"
-                    aditional_file.write(line)
-
-            self._close_file(aditional_file)
-
-            if save_file is False:
-                os.remove(aditional_path)
+
+    def _get_gul_path(self, inp_path, networkmode):
+        """ Gully sections go to an aditional .gul file when network mode is 2 """
+
+        if global_vars.project_type == 'ud' and networkmode and networkmode[0] == "2":
+            return inp_path.replace('.inp', f'.gul')
+        return None
 
 
     def _close_file(self, file=None):
@@ -399,63 +883,342 @@ class GwRecursiveEpa(task.GwTask):
 
     # region execute epa
     def execute_multi_epa(self):
+        """ Start the pool of EPA executions. INP files are submitted as soon as they are written
+        (see _submit_epa) and their RPT files are imported by import_rpt while next scenarios are exported """
 
         if self.isCanceled():
             return False
 
         tools_log.log_info(f"Execute EPA software")
 
-        # Set file to execute
-        opener = None
-        if global_vars.project_type in 'ws':
-            opener = f"{self.plugin_dir}{os.sep}resources{os.sep}epa{os.sep}epanet{os.sep}epanet.exe"
-        elif global_vars.project_type in 'ud':
-            opener = f"{self.plugin_dir}{os.sep}resources{os.sep}epa{os.sep}swmm{os.sep}swmm5.exe"
-
-        if opener is None:
+        # Time budget of every simulation
+        limits = {}
+        for option in ('timeout', 'cpu_limit'):
+            value = self.settings.value(f"options/{option}")
+            try:
+                limits[option] = float(value) if value else None
+            except ValueError:
+                tools_log.log_warning(f"Tried to set {option} to '{value}' but it's not a number. Simulations won't be limited.")
+                limits[option] = None
+
+        # Get EPA engine (executable or in process toolkit)
+        try:
+            if str(self.settings.value("options/distribute")).lower() in ('true', 'yes', '1'):
+                self.engine = self._get_job_engine(limits)
+            else:
+                self.engine = get_engine(global_vars.project_type, self.settings.value("options/engine"),
+                                         plugin_dir=self.plugin_dir,
+                                         executable=self.settings.value("options/executable"),
+                                         swmm_library=self.settings.value("options/swmm_library"), **limits)
+        except EngineError as e:
+            self.error_msg = str(e)
             return False
+        tools_log.log_info(f"EPA engine: {self.engine.version}")
+
+        self.result_cache = self._get_result_cache()
 
-        if not os.path.exists(opener):
-            self.error_msg = f"File not found: {opener}"
+        # Bounded simulation queue: exports wait (importing finished rpt files) while it is full
+        self.epa_slots = BoundedSemaphore(self.max_jobs if self.job_queue else self.max_threads * 2)
+        self.epa_executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        self.pending_imports = deque()
+
+        # Optional pool of processes to parse rpt files out of the GIL
+        self.parse_executor = None
+        parse_processes = self.settings.value("options/parse_processes")
+        try:
+            parse_processes = get_max_workers(parse_processes)
+        except ValueError:
+            msg = f"Tried to set parse_processes to '{parse_processes}' but it's not an integer. Parsing rpt files in the task."
+            tools_log.log_warning(msg)
+            parse_processes = 0
+        self.rpt_import = (self.settings.value("options/rpt_import") or 'json').lower()
+        if self.rpt_import not in ('json', 'copy'):
+            tools_log.log_warning(f"Unknown rpt_import '{self.rpt_import}'. Importing rpt files as JSON.")
+            self.rpt_import = 'json'
+        if parse_processes:
+            self.rpt_sources = self._get_rpt_sources()
+            self.parse_executor = create_process_pool(parse_processes)
+        self.max_backlog = 2 * (self.max_threads + parse_processes)
+        if self.job_queue:
+            # Submitted jobs wait in the backlog until they are imported
+            self.max_backlog += self.max_jobs
+
+        return True
+
+
+    def _get_job_engine(self, limits):
+        """ Engine that submits the simulations to the jobs folder, where workers on other machines
+        (cli.py worker) execute them """
+
+        max_jobs = self.settings.value("options/max_jobs")
+        try:
+            max_jobs = int(max_jobs) if max_jobs else MAX_JOBS
+        except ValueError:
+            tools_log.log_warning(f"Tried to set max_jobs to '{max_jobs}' but it's not an integer. Defaulting to {MAX_JOBS} jobs.")
+            max_jobs = MAX_JOBS
+        # Jobs submitted at the same time. They are followed by a single thread of the engine
+        self.max_jobs = max_jobs
+        try:
+            self.job_queue = JobQueue(os.path.join(self.path, f"{self.prefix}-jobs"))
+        except OSError as e:
+            raise EngineError(f"Couldn't create the jobs folder: {e}")
+        tools_log.log_info(f"EPA jobs folder: {self.job_queue.folder}")
+        return JobEngine(self.job_queue, global_vars.project_type, self.settings.value("options/engine"), **limits)
+
+
+    def _submit_epa(self, result_name, file_inp, file_rpt, simulated=False):
+        """ Simulate @file_inp and queue the import of its rpt file.
+        :param simulated: if True, @file_rpt already exists (resumed batch) and only has to be imported
+        """
+
+        if file_inp is None or not os.path.exists(file_inp):
+            self.error_msg = f"INP file not found: {file_inp}"
             return False
 
-        files_errors = []
-        for result_name, file_inp, file_rpt in self.file_pairs:
-            msg = "INP file not found"
-            if file_inp is not None:
-                if not os.path.exists(file_inp):
-                    self.error_msg = f"{msg}: {file_inp}"
-                    files_errors.append(file_inp)
+        while True:
+            if self.stop:
+                return False
+            if len(self.pending_imports) >= self.max_backlog:
+                self._import_next(timeout=0.1)
+            elif simulated or self.epa_slots.acquire(timeout=0.1):
+                break
             else:
-                self.error_msg = f"{msg}: {file_inp}"
+                self.import_rpt()
+
+        # Resolves to the parsed rpt (or None if it has to be parsed by the task) when it can be imported
+        rpt_future = Future()
+        if simulated:
+            self._submit_parse(result_name, file_rpt, rpt_future)
+        else:
+            if self.job_queue:
+                future = self._submit_job(result_name, file_inp, file_rpt)
+            else:
+                future = self.epa_executor.submit(self._execute_epa, result_name, file_inp, file_rpt)
+            future.add_done_callback(partial(self._epa_finished, result_name, file_rpt, rpt_future))
+        self.pending_imports.append((result_name, file_rpt, rpt_future))
 
-        # Using ThreadPoolExecutor to manage concurrent subprocesses
-        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            # Submitting subprocesses for each file_inp/file_rpt pair
-            subprocesses = [executor.submit(self._execute_epa, opener, file_inp, file_rpt)
-                            for _, file_inp, file_rpt in self.file_pairs if file_inp not in files_errors]
+        return True
 
-            # Wait for all subprocesses to complete
-            for subproc in subprocesses:
-                subproc.result()  # Wait for completion
 
-        self.common_msg += "EPA model finished. "
+    def _epa_finished(self, result_name, file_rpt, rpt_future, future):
+
+        self.epa_slots.release()
+        if future.cancelled():
+            rpt_future.set_result(None)
+            return
+        if isinstance(future.exception(), SimulationTimeout):
+            # Not imported: the rpt file is incomplete
+            self.timeouts.append(result_name)
+            tools_log.log_warning(str(future.exception()))
+            rpt_future.set_exception(future.exception())
+            return
+        if future.exception() is not None:
+            tools_log.log_warning(f"EPA execution failed: {future.exception()}")
+        elif os.path.exists(file_rpt):
+            self.manifest.mark(result_name, STAGE_SIMULATED)
+        self._submit_parse(result_name, file_rpt, rpt_future)
+
+
+    def _submit_parse(self, result_name, file_rpt, rpt_future):
+        """ Parse @file_rpt in the process pool, if any. Otherwise it is parsed by the task when importing it """
+
+        if self.parse_executor is None or self.stop:
+            rpt_future.set_result(None)
+            return
+
+        try:
+            if self.rpt_import == 'copy':
+                parse_future = self.parse_executor.submit(timed_call, write_copy_file, file_rpt, self.rpt_sources,
+                                                          global_vars.project_type, result_name, f"{file_rpt}.copy")
+            else:
+                parse_future = self.parse_executor.submit(timed_call, parse_rpt_file, file_rpt, self.rpt_sources,
+                                                          global_vars.project_type)
+        except Exception as e:
+            rpt_future.set_exception(e)
+            return
+        parse_future.add_done_callback(partial(self._rpt_parsed, result_name, rpt_future))
+
+
+    def _rpt_parsed(self, result_name, rpt_future, future):
+
+        if future.cancelled():
+            rpt_future.set_result(None)
+        elif future.exception() is not None:
+            rpt_future.set_exception(future.exception())
+        else:
+            parsed_rpt, seconds = future.result()
+            self.timer.record(result_name, "rpt_parse", seconds, process=True)
+            rpt_future.set_result(parsed_rpt)
+
+
+    def _shutdown_multi_epa(self):
+        """ Wait for the simulations and parses. When the task is stopped, queued ones are dropped and running
+        simulations have been killed (except toolkit ones, which can't be), but their callbacks still have to
+        finish before the timer and the manifest are closed """
+
+        executor = getattr(self, 'epa_executor', None)
+        if executor is None:
+            return
+        executor.shutdown(wait=True, cancel_futures=self.stop)
+        self.epa_executor = None
+        if self.parse_executor is not None:
+            self.parse_executor.shutdown(wait=True, cancel_futures=self.stop)
+            self.parse_executor = None
+        if self.stop:
+            # Jobs of the jobs folder are resolved by the poller of the engine once it sees the cancel
+            wait([rpt_future for _, _, rpt_future in self.pending_imports])
+        else:
+            self.common_msg += "EPA model finished. "
+        save_tuned_workers(self.tuning_file, self.settings.fileName(), self.tuner)
+        if self.result_cache is not None:
+            self.common_msg += f"Results from cache: {self.result_cache.hits}. "
+        if self.timeouts:
+            self.common_msg += f"Simulations over time limit: {len(self.timeouts)}. "
+        if self.resumed_count:
+            self.common_msg += f"Scenarios resumed from previous execution: {self.resumed_count}. "
+
+
+    def _close_timer(self):
+        """ Write the summary (p50/p95 of every phase) next to the timings file and save it in the history """
+
+        if self.timer is None or self.timer.closed:
+            return
+        self.timer.close()
+        summary = self.timer.summary()
+        summary["timeouts"] = sorted(self.timeouts)
+        try:
+            with open(os.path.join(self.path, f"{self.prefix}-timings-summary.json"), "w") as file:
+                json.dump(summary, file, indent=2)
+        except OSError as e:
+            tools_log.log_warning(f"Couldn't write timings summary: {e}")
+
+        # Keep the timings of complete batches to estimate the next ones (see BatchPlan)
+        if not self.stop and not self.error_msg and not self.function_failed:
+            history_file = get_history_file(global_vars.roaming_user_dir, global_vars.user_folder_name)
+            # Resumed scenarios aren't part of the wall time of this execution
+            save_history(history_file, self.history_key, summary, self.cur_idx - self.resumed_count)
+
+
+    def _get_result_cache(self):
+        """ Get cache of results from options 'cache_folder' and 'cache_max_size' (MB) """
+
+        cache_folder = self.settings.value("options/cache_folder")
+        if not cache_folder:
+            return None
+
+        max_size = self.settings.value("options/cache_max_size")
+        try:
+            max_size = float(max_size) * 1024 * 1024 if max_size else None
+        except ValueError:
+            msg = f"Tried to set cache_max_size to '{max_size}' but it's not a number. Cache size won't be limited."
+            tools_log.log_warning(msg)
+            max_size = None
+
+        return ResultCache(cache_folder, max_size)
 
-        return True
 
+    def _submit_job(self, result_name, file_inp, file_rpt):
+        """ Same as _execute_epa for the jobs folder, without a thread waiting for every job.
+        Returns a Future resolved when a worker has simulated @file_inp """
 
-    def _execute_epa(self, opener, file_inp, file_rpt):
-        subprocess.call([opener, file_inp, file_rpt], shell=False)
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.get_key(file_inp, self.engine.version)
+            if self.result_cache.fetch(key, file_rpt):
+                tools_log.log_info(f"Result found in cache: {file_inp}")
+                self.timer.record(result_name, "simulation", 0, cached=True)
+                future = Future()
+                future.set_result(None)
+                return future
+
+        t0 = time()
+        future = self.engine.submit(file_inp, file_rpt)
+        future.add_done_callback(partial(self._job_finished, result_name, file_rpt, key, t0))
+        return future
+
+
+    def _job_finished(self, result_name, file_rpt, key, t0, future):
+
+        extra = {'cached': False}
+        if isinstance(future.exception(), SimulationTimeout):
+            extra['timeout'] = True
+        elif future.exception() is None and os.path.exists(file_rpt):
+            # A failed simulation may leave a partial report, which must not be served again
+            if key is not None and future.result() == 0:
+                self.result_cache.store(key, file_rpt)
+            extra['bytes'] = os.path.getsize(file_rpt)
+        self.timer.record(result_name, "simulation", time() - t0, **extra)
+
+
+    def _execute_epa(self, result_name, file_inp, file_rpt):
+
+        with self.timer.measure(result_name, "simulation", cached=False) as extra:
+            # Skip simulation if the same INP file has already been simulated
+            key = None
+            if self.result_cache is not None:
+                key = self.result_cache.get_key(file_inp, self.engine.version)
+                if self.result_cache.fetch(key, file_rpt):
+                    tools_log.log_info(f"Result found in cache: {file_inp}")
+                    extra['cached'] = True
+                    return
+
+            with self.tuner.slot():
+                try:
+                    returncode = self.engine.run(file_inp, file_rpt)
+                except SimulationTimeout:
+                    extra['timeout'] = True
+                    raise
+
+            # A failed simulation may leave a partial report, which must not be served again
+            if key is not None and returncode == 0 and os.path.exists(file_rpt):
+                self.result_cache.store(key, file_rpt)
+            if os.path.exists(file_rpt):
+                extra['bytes'] = os.path.getsize(file_rpt)
 
     # endregion
 
     # region import rpt
-    def import_rpt(self):
-        for result_name, file_inp, file_rpt in self.file_pairs:
-            self._import_rpt(result_name, file_rpt)
+    def import_rpt(self, wait=False):
+        """ Import rpt files of finished EPA executions, keeping scenario order.
+        :param wait: if True, wait for all pending EPA executions
+        """
+
+        while self.pending_imports and not self.stop:
+            if not self._import_next(timeout=0.1 if wait else 0) and not wait:
+                return
+
+
+    def _import_next(self, timeout=0):
+        """ Import the first pending rpt file if it is ready. Returns False if it is not ready yet """
+
+        result_name, file_rpt, rpt_future = self.pending_imports[0]
+        try:
+            parsed_rpt = rpt_future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            return False
+        except SimulationTimeout:
+            self.pending_imports.popleft()
+            return True
+        except RptParseError as e:
+            self.pending_imports.popleft()
+            tools_log.log_info(f"Error near line {e.line_number} -> {file_rpt}")
+            self.error_msg = str(e)
+            return True
+        except Exception as e:
+            self.pending_imports.popleft()
+            self.error_msg = str(e)
+            return True
+
+        self.pending_imports.popleft()
+        if self._import_rpt(result_name, file_rpt, parsed_rpt):
+            self.manifest.mark(result_name, STAGE_IMPORTED)
+        return True
+
 
-    def _import_rpt(self, result_name, file_rpt):
-        """ Import result file """
+    def _import_rpt(self, result_name, file_rpt, parsed_rpt=None):
+        """ Import result file
+        :param parsed_rpt: JSON (or COPY file path) already parsed by a worker process
+        """
 
         tools_log.log_info(f"Import rpt file........: {file_rpt}")
 
@@ -464,11 +1227,20 @@ class GwRecursiveEpa(task.GwTask):
         status = False
         try:
             # Call import function
-            status = self._read_rpt_file(file_rpt)
-            if not status:
-                return False
+            if self.rpt_import == 'copy':
+                with self.timer.measure(result_name, "rpt_copy", process=parsed_rpt is not None):
+                    status = self._copy_rpt_file(result_name, file_rpt, parsed_rpt)
+                if not status:
+                    return False
+            elif parsed_rpt is None:
+                with self.timer.measure(result_name, "rpt_parse", process=False):
+                    status = self._read_rpt_file(file_rpt)
+                if not status:
+                    return False
+            else:
+                self.json_rpt = parsed_rpt
             tools_log.log_info(f"Task 'Go2Epa' execute function 'def _exec_import_function'")
-            status = self._exec_import_function(result_name)
+            status = self._exec_import_function(result_name, staged=self.rpt_import == 'copy')
         except Exception as e:
             self.error_msg = str(e)
         finally:
@@ -477,150 +1249,138 @@ class GwRecursiveEpa(task.GwTask):
 
     def _read_rpt_file(self, file_path=None):
 
-        self.file_rpt = open(file_path, "r+")
-        full_file = self.file_rpt.readlines()
-        progress = 0
+        if self.rpt_sources is None:
+            self.rpt_sources = self._get_rpt_sources()
+
+        rows = iter_rpt_rows(file_path, self.rpt_sources, global_vars.project_type, progress=self.setProgress)
+        json_rows = []
+        try:
+            for row in rows:
+                if self.isCanceled():
+                    return False
+                json_rows.append(row_to_json(*row))
+        except RptParseError as e:
+            tools_log.log_info(f"Error near line {e.line_number} -> {file_path}")
+            self.error_msg = str(e)
+            return False
+        finally:
+            rows.close()
+
+        self.json_rpt = '[' + ', '.join(json_rows) + ']'
+
+        return True
+
+
+    def _get_rpt_sources(self):
+        """ Get dict with sources from config_fprocess (loaded once per batch) """
 
-        # Create dict with sources
         sql = f"SELECT tablename, target FROM config_fprocess WHERE fid = {self.fid};"
         rows = tools_db.get_rows(sql, is_thread=True, aux_conn=self.aux_conn)
-        sources = {}
-        for row in rows:
-            json_elem = row[1].replace('{', '').replace('}', '')
-            item = json_elem.split(',')
-            for i in item:
-                sources[i.strip()] = row[0].strip()
-
-        # While we don't find a match with the target, target and col40 must be null
-        target = "null"
-        col40 = "null"
-        json_rpt = ""
-        # noinspection PyUnusedLocal
-        row_count = sum(1 for rows in full_file)
-
-        for line_number, row in enumerate(full_file):
+        return get_rpt_sources(rows)
 
-            if self.isCanceled():
-                self._close_file()
-                del full_file
+
+    def _copy_rpt_file(self, result_name, file_rpt, copy_path=None):
+        """ Load rpt rows into the staging table using COPY.
+        :param copy_path: COPY file already written by a worker process. If None, @file_rpt is parsed while copying
+        """
+
+        self.copy_error = None
+        conn = self._get_task_conn()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(get_copy_table_sql())
+            cursor.execute(f"DELETE FROM {COPY_TABLE} WHERE result_id = %s;", (result_name,))
+            if copy_path is not None:
+                with open(copy_path, "r") as copy_file:
+                    cursor.copy_expert(get_copy_sql(), copy_file, size=COPY_BUFFER_SIZE)
+            else:
+                if self.rpt_sources is None:
+                    self.rpt_sources = self._get_rpt_sources()
+                rows = iter_rpt_rows(file_rpt, self.rpt_sources, global_vars.project_type, progress=self.setProgress)
+                cursor.copy_expert(get_copy_sql(), CopyStream(self._iter_copy_lines(rows, result_name)),
+                                   size=COPY_BUFFER_SIZE)
+
+            if self.copy_error is not None or self.isCanceled():
+                conn.rollback()
+                if self.copy_error is not None:
+                    tools_log.log_info(f"Error near line {self.copy_error.line_number} -> {file_rpt}")
+                    self.error_msg = str(self.copy_error)
                 return False
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            if copy_path is not None and os.path.exists(copy_path):
+                os.remove(copy_path)
 
-            progress += 1
-            if '**' in row or '--' in row:
-                continue
+        return True
 
-            if global_vars.project_type == 'ud' and '>50' in row:
-                row = row.replace('>50', '50')
-
-            row = row.rstrip()
-            dirty_list = row.split(' ')
-
-            # Clean unused items
-            for x in range(len(dirty_list) - 1, -1, -1):
-                if dirty_list[x] == '':
-                    dirty_list.pop(x)
-
-            sp_n = []
-            if len(dirty_list) > 0:
-                for x in range(0, len(dirty_list)):
-                    if bool(re.search('[0-9][-]\d{1,2}[.]]*', str(dirty_list[x]))):
-                        last_index = 0
-                        for i, c in enumerate(dirty_list[x]):
-                            if "-" == c:
-                                json_elem = dirty_list[x][last_index:i]
-                                last_index = i
-                                sp_n.append(json_elem)
-
-                        # noinspection PyUnboundLocalVariable
-                        json_elem = dirty_list[x][last_index:i]
-                        sp_n.append(json_elem)
-
-                    elif bool(re.search('(\d\..*\.\d)', str(dirty_list[x]))):
-                        if 'Version' not in dirty_list and 'VERSION' not in dirty_list:
-                            error_near = f"Error near line {line_number+1} -> {dirty_list}"
-                            tools_log.log_info(error_near)
-                            message = (f"The rpt file is not valid to import. "
-                                       f"Because columns on rpt file are overlaped, it seems you need to improve your simulation. "
-                                       f"Please ckeck and fix it before continue. \n"
-                                       f"{error_near}")
-                            self.error_msg = message
-                            self._close_file()
-                            del full_file
-                            return False
-                    elif bool(re.search('>50', str(dirty_list[x]))):
-                        error_near = f"Error near line {line_number+1} -> {dirty_list}"
-                        tools_log.log_info(error_near)
-                        message = (f"The rpt file is not valid to import. "
-                                   f"Because velocity has not numeric value (>50), it seems you need to improve your simulation. "
-                                   f"Please ckeck and fix it before continue. \n"
-                                   f"{error_near}")
-                        self.error_msg = message
-                        self._close_file()
-                        del full_file
-                        return False
-                    else:
-                        sp_n.append(dirty_list[x])
 
-            # Find strings into dict and set target column
-            for k, v in sources.items():
-                try:
-                    if k in (f'{sp_n[0]} {sp_n[1]}', f'{sp_n[0]}'):
-                        target = "'" + v + "'"
-                        _time = re.compile('^([012]?[0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]$')
-                        if _time.search(sp_n[3]):
-                            col40 = "'" + sp_n[3] + "'"
-                except IndexError:
-                    pass
-                except Exception as e:
-                    tools_log.log_info(type(e).__name__)
-
-            if len(sp_n) > 0:
-                json_elem = f'"target": "{target}", "col40": "{col40}", '
-                for x in range(0, len(sp_n)):
-                    json_elem += f'"col{x + 1}":'
-                    if "''" not in sp_n[x]:
-                        value = '"' + sp_n[x].strip().replace("\n", "") + '", '
-                        value = value.replace("''", "null")
-                    else:
-                        value = 'null, '
-                    json_elem += value
-
-                json_elem = '{' + str(json_elem[:-2]) + '}, '
-                json_rpt += json_elem
-
-            # Update progress bar
-            if progress % 1000 == 0:
-                self.setProgress((line_number * 100) / row_count)
-
-        # Manage JSON
-        json_rpt = '[' + str(json_rpt[:-2]) + ']'
-        self.json_rpt = json_rpt
+    def _iter_copy_lines(self, rows, result_name):
+        """ Stop the COPY when the task is canceled. Parse errors are kept in self.copy_error,
+        because psycopg2 hides exceptions raised while reading the COPY data """
 
-        self._close_file()
-        del full_file
+        try:
+            for line in iter_copy_lines(rows, result_name):
+                if self.isCanceled():
+                    return
+                yield line
+        except RptParseError as e:
+            self.copy_error = e
 
-        return True
 
+    def _delete_copy_rows(self, result_name):
 
-    def _exec_import_function(self, result_name):
-        """ Call function gw_fct_rpt2pg_main """
+        conn = self._get_task_conn()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"DELETE FROM {COPY_TABLE} WHERE result_id = %s;", (result_name,))
+            conn.commit()
+        finally:
+            cursor.close()
+
+
+    def _get_task_conn(self):
+        return self.aux_conn or tools_db.dao.conn
+
+
+    def _exec_import_function(self, result_name, staged=False):
+        """ Call function gw_fct_rpt2pg_main
+        :param staged: if True, rpt rows have been copied into the staging table and the 'file' array
+            is built by the database instead of being sent inside the body. gw_fct_rpt2pg_main still
+            receives it as JSON, so the server builds the whole report for every step
+        """
 
         extras = f'"resultId":"{result_name}"'
         if self.json_rpt:
             extras += f', "file": {self.json_rpt}'
-        for i in range(1, 3):
-            self.body = tools_gw.create_body(extras=extras + f', "step": {i}')
-            self.json_result = tools_gw.execute_procedure('gw_fct_rpt2pg_main', self.body,
-                                                          aux_conn=self.aux_conn, is_thread=True)
-            self.rpt_result = self.json_result
-            if self.json_result is None or not self.json_result:
-                self.function_failed = True
-                return False
-
-            if 'status' in self.json_result and self.json_result['status'] == 'Failed':
-                tools_log.log_warning(self.json_result)
-                self.function_failed = True
-                return False
+        file_sql = None
+        if staged:
+            result_id = "'" + result_name.replace("'", "''") + "'"
+            file_sql = get_copy_json_sql(result_id)
+        try:
+            for i in range(1, 3):
+                self.body = tools_gw.create_body(extras=extras + f', "step": {i}')
+                parameters = self.body
+                if file_sql:
+                    parameters = f"jsonb_set({self.body}::jsonb, '{{data,file}}', {file_sql}::jsonb)::json"
+                with self.timer.measure(result_name, f"rpt2pg_step{i}"):
+                    self.json_result = tools_gw.execute_procedure('gw_fct_rpt2pg_main', parameters,
+                                                                  aux_conn=self.aux_conn, is_thread=True)
+                self.rpt_result = self.json_result
+                if self.json_result is None or not self.json_result:
+                    self.function_failed = True
+                    return False
+
+                if 'status' in self.json_result and self.json_result['status'] == 'Failed':
+                    tools_log.log_warning(self.json_result)
+                    self.function_failed = True
+                    return False
+        finally:
+            if staged:
+                self._delete_copy_rows(result_name)
 
         # final message
         self.common_msg += "Import RPT file finished."
@@ -628,3 +1388,7 @@ class GwRecursiveEpa(task.GwTask):
         return True
 
     # endregion
+
+
+def _quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
@@ -17,6 +17,7 @@ from qgis.PyQt.QtCore import QTimer
 from qgis.PyQt.QtWidgets import QFileDialog, QWidget
 
 from ...threads.add_demand_check import GwAddDemandCheck
+from ...utils.demand_check import ENGINES, PARALLEL_MODES, PARALLEL_PROCESSES, SCREENING_MODES
 from ...ui.ui_manager import AddDemandCheckUi
 from .... import global_vars
 from ....settings import tools_db, tools_gw, tools_qt
@@ -104,34 +105,6 @@ class AddDemandCheck:
         if file_path:
             tools_qt.set_widget_text(self.dlg_adc, widget, str(file_path))
 
-    def _get_nodes_from_db(self):
-        sql = """
-            select node_id, addparam
-            from anl_node
-            where fid = 491 and cur_user = current_user
-            """
-
-        rows = tools_db.get_rows(sql)
-        if not rows:
-            return {}
-
-        nodes = {}
-        for node_id, addparam_str in rows:
-            addparam = json.loads(addparam_str)
-            demand = addparam["requiredDemand"]
-            pressure = addparam["requiredPressure"]
-
-            if node_id in nodes:
-                raise ValueError(f"Node {node_id} duplicated in config file.")
-
-            nodes[node_id] = {
-                "name": node_id,
-                "requiredDemand": demand,
-                "requiredPressure": pressure,
-            }
-
-        return nodes
-
     def _load_user_values(self):
         self._user_values("load")
 
@@ -303,7 +276,7 @@ class AddDemandCheck:
                 tools_qt.show_info_box(msg)
                 return False
         else:
-            config.junctions = self._get_nodes_from_db()
+            config.junctions = get_nodes_from_db()
             if len(config.junctions) == 0:
                 msg = "There is no data in table anl_arc for fid=491 and current user."
                 tools_qt.show_info_box(msg)
@@ -331,6 +304,35 @@ class AddDemandCheck:
         return True
 
 
+def get_nodes_from_db():
+    sql = """
+        select node_id, addparam
+        from anl_node
+        where fid = 491 and cur_user = current_user
+        """
+
+    rows = tools_db.get_rows(sql)
+    if not rows:
+        return {}
+
+    nodes = {}
+    for node_id, addparam_str in rows:
+        addparam = json.loads(addparam_str)
+        demand = addparam["requiredDemand"]
+        pressure = addparam["requiredPressure"]
+
+        if node_id in nodes:
+            raise ValueError(f"Node {node_id} duplicated in config file.")
+
+        nodes[node_id] = {
+            "name": node_id,
+            "requiredDemand": demand,
+            "requiredPressure": pressure,
+        }
+
+    return nodes
+
+
 class ConfigADC:
     def __init__(self, config_file):
         self.options = {}
@@ -342,6 +344,10 @@ class ConfigADC:
             if option not in self.options:
                 raise ValueError(f"{option} not found in [OPTIONS] section.")
 
+        # Simulations in threads of QGIS can't be stopped, only processes can be killed
+        if "timeout" in self.options and self.options.get("parallel") != PARALLEL_PROCESSES:
+            raise ValueError("timeout can only be used with parallel processes.")
+
     def _parse_file(self, config_file):
         with open(config_file) as file:
             section = ""
@@ -361,6 +367,28 @@ class ConfigADC:
     def _process_option(self, tokens):
         if tokens[0].lower() == "max_distance":
             self.options["max_distance"] = float(tokens[1])
+        elif tokens[0].lower() == "max_workers":
+            value = tokens[1].lower()
+            if value != "auto":
+                value = int(value)
+            self.options["max_workers"] = value
+        elif tokens[0].lower() == "timeout":
+            self.options["timeout"] = float(tokens[1])
+        elif tokens[0].lower() == "engine":
+            value = tokens[1].lower()
+            if value not in ENGINES:
+                raise ValueError(f"Unknown engine: {tokens[1]}. Use {' or '.join(ENGINES)}.")
+            self.options["engine"] = value
+        elif tokens[0].lower() == "parallel":
+            value = tokens[1].lower()
+            if value not in PARALLEL_MODES:
+                raise ValueError(f"Unknown parallel: {tokens[1]}. Use {' or '.join(PARALLEL_MODES)}.")
+            self.options["parallel"] = value
+        elif tokens[0].lower() == "screening":
+            value = tokens[1].lower()
+            if value not in SCREENING_MODES:
+                raise ValueError(f"Unknown screening: {tokens[1]}. Use {' or '.join(SCREENING_MODES)}.")
+            self.options["screening"] = value
 
     def _process_junction(self, tokens):
         node = tokens[0]
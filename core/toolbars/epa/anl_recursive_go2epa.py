@@ -16,6 +16,8 @@ from qgis.PyQt.QtCore import QSettings
 
 from ...ui.ui_manager import RecursiveEpaUi
 from ...threads.recursive_epa import GwRecursiveEpa
+from ...utils.planner import BatchPlan, get_history_file, get_history_key, load_history
+from ...utils.scenarios import TRAVERSAL_NESTED, read_levels, read_traversal
 from .... import global_vars
 from ....settings import tools_qgis, tools_qt, tools_gw, dialog, tools_os, tools_log, tools_db
 
@@ -82,18 +84,21 @@ class RecursiveEpa():
             return
         settings = QSettings(setting_file, QSettings.IniFormat)
         settings.setIniCodec(sys.getfilesystemencoding())
-        list1 = settings.value("list1/list1")
-        list2 = settings.value("list2/list1")
-        list3 = settings.value("list3/list1")
-
-        msg = "These are the lists that will be used. Do you want to continue?"
-        if settings.value("list1/list2") or settings.value("list2/list2") or settings.value("list3/list2"):
-            msg = "There are multiple queries configured." + msg
-        inf_text = f"{list1}"
-        if list2:
-            inf_text += f"\n{list2}"
-            if list3:
-                inf_text += f"\n{list3}"
+
+        # Expand scenarios and estimate the batch from previous executions, without touching the database
+        levels = read_levels(settings)
+        if not levels:
+            message = f"There are no lists configured in: {setting_file}"
+            self.iface.messageBar().pushMessage("", message, 1, 20)
+            return
+        history_file = get_history_file(global_vars.roaming_user_dir, global_vars.user_folder_name)
+        history = load_history(history_file, get_history_key(QgsProject.instance().fileName(), settings.fileName()))
+        plan = BatchPlan(levels, prefix, history, read_traversal(settings) or TRAVERSAL_NESTED)
+
+        msg = "This is the batch that will be executed. Do you want to continue?"
+        if any(len(level.queries) > 1 for level in levels):
+            msg = "There are multiple queries configured. " + msg
+        inf_text = plan.get_text()
         response = tools_qt.show_question(msg, inf_text=inf_text, force_action=True)
         if response:
             self.recursive_epa = GwRecursiveEpa("Recursive Go2Epa", prefix, folder_path, settings, global_vars.plugin_dir)
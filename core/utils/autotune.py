@@ -0,0 +1,192 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import ctypes
+import json
+import os
+import sys
+from contextlib import contextmanager
+from threading import Condition, Lock
+from time import perf_counter
+
+AUTO = 'auto'
+TUNING_FILE = 'autotune.json'
+
+# Relative throughput change considered significant when tuning
+_TOLERANCE = 0.05
+# Reduce concurrency when the available memory falls under this fraction
+_MIN_FREE_MEMORY = 0.10
+
+_file_lock = Lock()
+
+
+class ConcurrencyTuner:
+    """ Limits how many simulations run at the same time and, if @minimum != @maximum, adapts that limit
+    by hill climbing: it is increased while throughput (simulations per second) improves, reduced when
+    throughput drops, and reduced as well when the system is running out of memory
+    """
+
+    def __init__(self, initial=None, minimum=1, maximum=None):
+
+        cpu_count = os.cpu_count() or 1
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum or 2 * cpu_count, self.minimum)
+        self.limit = self._clamp(initial or cpu_count)
+        self.best_limit = self.limit
+        self.wall_times = []
+        self._best_throughput = None
+        self._last_throughput = None
+        self._direction = 1
+        self._active = 0
+        self._completed = 0
+        self._window_start = None
+        self._condition = Condition()
+
+    @property
+    def adaptive(self):
+        return self.minimum != self.maximum
+
+    @contextmanager
+    def slot(self):
+        """ Wait until a simulation can start and measure it """
+
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+            if self._window_start is None:
+                self._window_start = perf_counter()
+
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = perf_counter() - t0
+            with self._condition:
+                self._active -= 1
+                self._record(wall_time)
+                self._condition.notify_all()
+
+    def _record(self, wall_time):
+
+        self.wall_times.append(wall_time)
+        if not self.adaptive:
+            return
+
+        self._completed += 1
+        if self._completed < max(2 * self.limit, 4):
+            return
+
+        throughput = self._completed / (perf_counter() - self._window_start)
+        if self._best_throughput is None or throughput > self._best_throughput:
+            self._best_throughput = throughput
+            self.best_limit = self.limit
+
+        step = True
+        free_memory = get_available_memory_fraction()
+        if free_memory is not None and free_memory < _MIN_FREE_MEMORY:
+            self._direction = -1
+        elif self._last_throughput is not None:
+            if throughput < self._last_throughput * (1 - _TOLERANCE):
+                # Last change made it worse: go back
+                self._direction = -self._direction
+            elif throughput <= self._last_throughput * (1 + _TOLERANCE):
+                # No significant change: keep current limit
+                step = False
+
+        self._last_throughput = throughput
+        if step:
+            self.limit = self._clamp(self.limit + self._direction)
+
+        # Start a new measurement window with the new limit
+        self._completed = 0
+        self._window_start = perf_counter()
+
+    def _clamp(self, value):
+        return min(max(int(value), self.minimum), self.maximum)
+
+
+def get_tuner(value, default=4, tuning_file=None, key=None):
+    """ Get a ConcurrencyTuner from an option value: a fixed number of workers, or 'auto'.
+    With 'auto' it starts from the value learned in previous executions of @key (if any) or the number of CPUs
+    """
+
+    if value is None or str(value).strip() == '':
+        value = default
+    if str(value).strip().lower() != AUTO:
+        value = int(value)
+        return ConcurrencyTuner(value, value, value)
+
+    return ConcurrencyTuner(initial=load_tuned_workers(tuning_file, key))
+
+
+def get_tuning_file(*folders):
+    """ Path of the file where learned settings are saved, inside the user config folder """
+
+    if not all(folders):
+        return None
+    return os.path.join(*folders, TUNING_FILE)
+
+
+def load_tuned_workers(tuning_file, key):
+    """ Number of workers learned in previous executions of @key """
+
+    if not tuning_file or not key or not os.path.exists(tuning_file):
+        return None
+    try:
+        with _file_lock, open(tuning_file) as file:
+            return json.load(file).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_tuned_workers(tuning_file, key, tuner):
+    """ Persist the best number of workers found by @tuner for @key """
+
+    if not tuning_file or not key or not tuner.adaptive:
+        return
+    try:
+        with _file_lock:
+            values = {}
+            if os.path.exists(tuning_file):
+                with open(tuning_file) as file:
+                    values = json.load(file)
+            values[key] = tuner.best_limit
+            with open(tuning_file, "w") as file:
+                json.dump(values, file, indent=2)
+    except (OSError, ValueError):
+        pass
+
+
+def get_available_memory_fraction():
+    """ Fraction of physical memory available, or None if it can't be known """
+
+    if sys.platform.startswith('linux'):
+        try:
+            info = {}
+            with open('/proc/meminfo') as file:
+                for line in file:
+                    name, value = line.split(':', 1)
+                    info[name] = int(value.split()[0])
+            return info['MemAvailable'] / info['MemTotal']
+        except (OSError, KeyError, ValueError, ZeroDivisionError):
+            return None
+
+    if sys.platform == 'win32':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return None
+        return status.ullAvailPhys / status.ullTotalPhys
+
+    return None
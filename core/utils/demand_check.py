@@ -0,0 +1,322 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import copy
+import math
+import os
+import shutil
+import tempfile
+import uuid
+from multiprocessing.util import Finalize
+from pathlib import Path
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    import wntr
+    from wntr.epanet.toolkit import ENepanet
+    from wntr.epanet.util import from_si, to_si, FlowUnits, HydParam
+except ImportError:
+    wntr = None
+    ENepanet = None
+
+# Engines of the Additional Demand Check ('engine' option)
+ENGINE_WNTR = 'wntr'
+ENGINE_TOOLKIT = 'toolkit'
+ENGINES = (ENGINE_WNTR, ENGINE_TOOLKIT)
+
+# Where the simulations run ('parallel' option)
+PARALLEL_THREADS = 'threads'
+PARALLEL_PROCESSES = 'processes'
+PARALLEL_MODES = (PARALLEL_THREADS, PARALLEL_PROCESSES)
+
+# Checks decided without simulating them ('screening' option)
+SCREENING_OFF = 'off'
+SCREENING_BASE = 'base'
+SCREENING_MODES = (SCREENING_OFF, SCREENING_BASE)
+
+# Maximum number of distances computed at once by get_pairs_within
+MAX_DISTANCES = 1 << 20
+
+# EPANET toolkit node parameters
+EN_BASEDEMAND = 1
+EN_DEMAND = 9
+EN_PRESSURE = 11
+
+
+class ToolkitSession:
+    """ EPANET toolkit project with the base network open, reused for all the checks of one worker.
+    A check only changes the base demand of its nodes, solves one hydraulic snapshot and restores them,
+    instead of copying the whole network and writing and reading an INP file for every simulation.
+    Demands and pressures are in the units of the INP file.
+    """
+
+    def __init__(self, file_inp):
+
+        if ENepanet is None:
+            raise ImportError("The EPANET toolkit of WNTR is not available")
+        self._folder = tempfile.mkdtemp(prefix="adc-")
+        self._lock = Lock()
+        self._indexes = {}
+        self._base_demands = {}
+        self.en = ENepanet()
+        self.en.ENopen(file_inp, os.path.join(self._folder, "session.rpt"), os.path.join(self._folder, "session.bin"))
+        self.en.ENopenH()
+
+    def simulate(self, demands):
+        """ Add @demands ({node name: extra demand}) and solve the network.
+        Returns {node name: (model demand, model pressure)}, the model demand without the base demand
+        """
+
+        with self._lock:
+            indexes = {name: self._get_index(name) for name in demands}
+            try:
+                for name, demand in demands.items():
+                    self.en.ENsetnodevalue(indexes[name], EN_BASEDEMAND, self._base_demands[name] + demand)
+                self.en.ENinitH(0)
+                self.en.ENrunH()
+                return {
+                    name: (
+                        self.en.ENgetnodevalue(index, EN_DEMAND) - self._base_demands[name],
+                        self.en.ENgetnodevalue(index, EN_PRESSURE),
+                    )
+                    for name, index in indexes.items()
+                }
+            finally:
+                for name, index in indexes.items():
+                    self.en.ENsetnodevalue(index, EN_BASEDEMAND, self._base_demands[name])
+
+    def close(self):
+        """ Close the project. Waits for the simulation being solved, if any """
+
+        with self._lock:
+            if self.en is None:
+                return
+            try:
+                self.en.ENcloseH()
+                self.en.ENclose()
+            finally:
+                self.en = None
+                shutil.rmtree(self._folder, ignore_errors=True)
+
+    def _get_index(self, name):
+
+        if name not in self._indexes:
+            index = self.en.ENgetnodeindex(name)
+            self._indexes[name] = index
+            self._base_demands[name] = self.en.ENgetnodevalue(index, EN_BASEDEMAND)
+        return self._indexes[name]
+
+
+def get_node_result(node, model_demand, model_pressure, accuracy):
+    """ Result of the check of @node (with 'name', 'requiredDemand' and 'requiredPressure') """
+
+    status = (
+        "ok"
+        if node["requiredDemand"] <= model_demand + accuracy
+        and node["requiredPressure"] <= model_pressure + accuracy
+        else "failed"
+    )
+    return {
+        "status": status,
+        "requiredDemand": node["requiredDemand"],
+        "requiredPressure": node["requiredPressure"],
+        "modelDemand": model_demand,
+        "modelPressure": model_pressure,
+    }
+
+
+def simulate_wntr(network, adjusted_demands, demands):
+    """ Add @demands ({node name: extra demand}) to a copy of @network and simulate it with EPANET.
+    Returns {node name: (model demand, model pressure)} in the units of the INP file
+    """
+
+    test_wn = copy.deepcopy(network)
+    units = test_wn.options.hydraulic.inpfile_units
+    pat = test_wn.get_pattern("constant_pattern")
+    for name, demand in demands.items():
+        junction = test_wn.get_node(name)
+        demand = to_si(FlowUnits[units], demand, HydParam.Demand)
+        junction.demand_timeseries_list.append((demand, pat))
+
+    prefix = str(Path.home() / ".temp/") + str(uuid.uuid4()).split("-")[0]
+    results = wntr.sim.EpanetSimulator(test_wn).run_sim(file_prefix=prefix).node
+
+    values = {}
+    for name in demands:
+        node_extra_demand = (
+            results["demand"][name][0].item() - adjusted_demands[name]
+        )
+        model_demand = from_si(
+            FlowUnits[units],
+            node_extra_demand,
+            HydParam.Demand,
+        )
+        model_pressure = from_si(
+            FlowUnits[units],
+            results["pressure"][name][0].item(),
+            HydParam.Pressure,
+        )
+        values[name] = (model_demand, model_pressure)
+    return values
+
+
+def get_pairs_within(names, coordinates, max_distance):
+    """ Pairs of nodes whose distance is at most @max_distance.
+    Every node is compared with the previous ones, so a pair is (later name, earlier name) in @names.
+    Pairs are found with a KD-tree if SciPy is available (it is a dependency of WNTR). Otherwise only nodes
+    in neighbouring cells of a grid of @max_distance are compared with NumPy, MAX_DISTANCES at a time.
+    :param coordinates: (x, y) of every node of @names
+    """
+
+    if np is None:
+        return _get_pairs_within_python(names, coordinates, max_distance)
+
+    pairs = set()
+    if len(names) < 2 or max_distance < 0:
+        return pairs
+
+    xy = np.asarray(coordinates, dtype=float).reshape(len(names), 2)
+    valid = np.flatnonzero(np.isfinite(xy).all(axis=1))
+
+    if cKDTree is not None:
+        found = cKDTree(xy[valid]).query_pairs(max_distance, output_type='ndarray')
+        # query_pairs gives i < j, and valid is sorted
+        for i, j in zip(valid[found[:, 0]].tolist(), valid[found[:, 1]].tolist()):
+            pairs.add((names[j], names[i]))
+        return pairs
+
+    # Cells slightly bigger than max_distance, so rounding can't separate two nodes in range by two cells
+    cell_size = max_distance * (1 + 1e-9) if max_distance > 0 else 1.0
+    cells = np.floor(xy[valid] / cell_size).astype(np.int64)
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    sorted_cells = cells[order]
+    starts = np.flatnonzero(np.any(np.diff(sorted_cells, axis=0) != 0, axis=1)) + 1
+    grid = {
+        tuple(sorted_cells[start].tolist()): valid[group]
+        for start, group in zip(np.r_[0, starts], np.split(order, starts))
+    }
+
+    # Each cell with itself and half of its neighbours, so every couple of cells is compared once
+    offsets = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+    for (cx, cy), group in grid.items():
+        for dx, dy in offsets:
+            other = grid.get((cx + dx, cy + dy))
+            if other is None:
+                continue
+            # Crowded cells (e.g. nodes on the same coordinates) are compared in chunks of rows
+            b = xy[other]
+            step = max(MAX_DISTANCES // len(other), 1)
+            for start in range(0, len(group), step):
+                rows_group = group[start:start + step]
+                a = xy[rows_group]
+                distances = np.sqrt(
+                    (a[:, None, 0] - b[None, :, 0]) ** 2
+                    + (a[:, None, 1] - b[None, :, 1]) ** 2
+                )
+                rows, cols = np.nonzero(distances <= max_distance)
+                for i, j in zip(rows_group[rows].tolist(), other[cols].tolist()):
+                    if i > j:
+                        pairs.add((names[i], names[j]))
+                    elif i < j and (dx, dy) != (0, 0):
+                        pairs.add((names[j], names[i]))
+    return pairs
+
+
+def _get_pairs_within_python(names, coordinates, max_distance):
+
+    pairs = set()
+    for i, (x1, y1) in enumerate(coordinates):
+        for j in range(i):
+            x2, y2 = coordinates[j]
+            if math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2) <= max_distance:
+                pairs.add((names[i], names[j]))
+    return pairs
+
+
+def get_pruned_pairs(node_name, results, node_pairs):
+    """ Candidate pairs of @node_name that don't have to be checked, given the individual @results of the nodes.
+    All of them if the node has an error (e.g. its simulation exceeded the time limit) or failed its simple test,
+    and the ones with another node that also passed its doubled test.
+    :param node_pairs: {node name: set of candidate pairs of the node}
+    """
+
+    result = results[node_name]
+    pairs = node_pairs.get(node_name, set())
+    if "error" in result or result["simple"]["status"] == "failed":
+        return set(pairs)
+    if result["doubled"]["status"] != "ok":
+        return set()
+
+    pruned = set()
+    for pair in pairs:
+        n1, n2 = pair
+        other = n2 if n1 == node_name else n1
+        if (
+            other in results
+            and "error" not in results[other]
+            and results[other]["doubled"]["status"] == "ok"
+        ):
+            pruned.add(pair)
+    return pruned
+
+
+def is_pair_skipped(pair, results):
+    """ True if @pair mustn't be simulated: it was checked in a previous execution or one of its nodes
+    has an error (e.g. a resumed execution whose node exceeded the time limit) """
+
+    node1_name, node2_name = pair
+    if any("error" in results[name] for name in pair):
+        return True
+    return node2_name in results[node1_name]["paired"]
+
+
+# State of every process of the pool, set by init_worker
+_worker = {}
+
+
+def init_worker(engine, base_inp):
+    """ Initializer of the processes of the pool. They only receive the path of the prepared network
+    (@base_inp, written by the task), which every process reads the first time it simulates
+    """
+
+    _worker.update(
+        engine=engine,
+        base_inp=base_inp,
+        network=None,
+        adjusted_demands=None,
+        session=None,
+    )
+
+
+def simulate_in_worker(demands):
+    """ Same as simulate_wntr or ToolkitSession.simulate, in a process of the pool.
+    Only the demand and pressure of the nodes of @demands are sent back to the task
+    """
+
+    if _worker["engine"] == ENGINE_TOOLKIT:
+        if _worker["session"] is None:
+            session = ToolkitSession(_worker["base_inp"])
+            # Close the project when the process exits
+            Finalize(session, session.close, exitpriority=10)
+            _worker["session"] = session
+        return _worker["session"].simulate(demands)
+    if _worker["network"] is None:
+        network = wntr.network.read_inpfile(_worker["base_inp"])
+        # Demands of the prepared network are the adjusted demands, with a constant pattern
+        _worker["adjusted_demands"] = wntr.metrics.hydraulic.average_expected_demand(network)
+        _worker["network"] = network
+    return simulate_wntr(_worker["network"], _worker["adjusted_demands"], demands)
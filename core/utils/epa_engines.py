@@ -0,0 +1,317 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from threading import Lock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .result_cache import get_file_hash
+
+try:
+    import wntr
+    from wntr.epanet.toolkit import ENepanet
+except ImportError:
+    wntr = None
+
+ENGINE_AUTO = 'auto'
+ENGINE_EXECUTABLE = 'executable'
+ENGINE_TOOLKIT = 'toolkit'
+
+
+class EngineError(Exception):
+    """ Raised when the requested EPA engine is not available """
+
+
+class SimulationCanceled(EngineError):
+    """ Raised when a simulation is requested (or killed) after the engine has been canceled """
+
+
+class SimulationTimeout(EngineError):
+    """ Raised when a simulation exceeds its wall-clock or CPU time budget and is killed """
+
+
+class EpaEngine:
+    """ Runs one simulation: reads an INP file and writes its RPT file """
+
+    name = None
+    # Whether timeout and cpu_limit can be enforced (only for simulations run in child processes)
+    supports_limits = False
+
+    def __init__(self, timeout=None, cpu_limit=None):
+        self.canceled = False
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+
+    def cancel(self):
+        """ Don't start more simulations. Engines running in child processes kill the running ones too """
+        self.canceled = True
+
+    def _check_canceled(self):
+        if self.canceled:
+            raise SimulationCanceled("Simulation canceled")
+
+    @property
+    def version(self):
+        """ Identifies the results produced by the engine (used by the result cache) """
+        return self.name
+
+    def run(self, file_inp, file_rpt):
+        """ Simulate @file_inp, writing its report to @file_rpt. Returns the return code (0 on success) """
+        raise NotImplementedError
+
+
+class SubprocessEngine(EpaEngine):
+    """ Executes an EPA command line program (epanet.exe, swmm5.exe, runepanet...) for each simulation """
+
+    name = ENGINE_EXECUTABLE
+    supports_limits = True
+
+    def __init__(self, opener, timeout=None, cpu_limit=None):
+        super().__init__(timeout, cpu_limit)
+        self.opener = opener
+        self._version = None
+        self._processes = set()
+        self._lock = Lock()
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = f"{self.name}:{get_file_hash(self.opener)}"
+        return self._version
+
+    def run(self, file_inp, file_rpt):
+
+        # Every simulation runs in its own process group, so the whole group can be killed
+        if sys.platform == 'win32':
+            kwargs = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            kwargs = {'start_new_session': True}
+
+        with self._lock:
+            self._check_canceled()
+            process = subprocess.Popen([self.opener, file_inp, file_rpt], shell=False, **kwargs)
+            self._processes.add(process)
+        try:
+            if self.cpu_limit:
+                _set_cpu_limit(process.pid, self.cpu_limit)
+            try:
+                returncode = process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                _kill_process(process)
+                process.wait()
+                raise SimulationTimeout(f"Simulation exceeded {self.timeout} seconds: {file_inp}")
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+
+        self._check_canceled()
+        if self.cpu_limit and returncode in _CPU_LIMIT_RETURNCODES:
+            raise SimulationTimeout(f"Simulation exceeded {self.cpu_limit} seconds of CPU: {file_inp}")
+        return returncode
+
+    def cancel(self):
+
+        with self._lock:
+            super().cancel()
+            for process in self._processes:
+                _kill_process(process)
+
+
+class EpanetToolkitEngine(EpaEngine):
+    """ Runs EPANET in process through the toolkit shipped with WNTR.
+    Every simulation has its own project, so they can run in parallel. They can't be killed
+    """
+
+    name = ENGINE_TOOLKIT
+
+    @property
+    def version(self):
+        return f"{self.name}:wntr-{wntr.__version__}"
+
+    def run(self, file_inp, file_rpt):
+
+        self._check_canceled()
+        fd, file_out = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        en = ENepanet()
+        try:
+            en.ENopen(file_inp, file_rpt, file_out)
+            try:
+                en.ENsolveH()
+                en.ENsolveQ()
+                en.ENreport()
+            finally:
+                en.ENclose()
+        finally:
+            if os.path.exists(file_out):
+                os.remove(file_out)
+        return 0
+
+
+class SwmmLibraryEngine(EpaEngine):
+    """ Runs SWMM in process through its shared library (swmm5.dll, libswmm5.so, libswmm5.dylib).
+    Simulations run one at a time (see _lock) and can't be killed, so it is only used when requested
+    """
+
+    name = ENGINE_TOOLKIT
+    # SWMM keeps its project in global variables, so only one simulation can run at a time per process
+    _lock = Lock()
+
+    def __init__(self, library, timeout=None, cpu_limit=None):
+        super().__init__(timeout, cpu_limit)
+        self.library = library
+        self.lib = ctypes.CDLL(library)
+        self.lib.swmm_run.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
+        self.lib.swmm_run.restype = ctypes.c_int
+        self._version = None
+
+    @property
+    def version(self):
+        if self._version is None:
+            library = get_file_hash(self.library) if os.path.exists(self.library) else self.library
+            self._version = f"{self.name}:{library}"
+        return self._version
+
+    def run(self, file_inp, file_rpt):
+
+        fd, file_out = tempfile.mkstemp(suffix=".out")
+        os.close(fd)
+        encoding = sys.getfilesystemencoding()
+        try:
+            with self._lock:
+                self._check_canceled()
+                return self.lib.swmm_run(file_inp.encode(encoding), file_rpt.encode(encoding),
+                                         file_out.encode(encoding))
+        finally:
+            if os.path.exists(file_out):
+                os.remove(file_out)
+
+
+def get_engine(project_type, engine=ENGINE_AUTO, plugin_dir=None, executable=None, swmm_library=None,
+               timeout=None, cpu_limit=None):
+    """ Get the EPA engine for @project_type.
+    :param engine: 'executable', 'toolkit' or 'auto' (EPANET toolkit for 'ws' projects outside Windows
+        when there are no limits, falling back to the executable if it isn't available; executables otherwise)
+    :param executable: command line program to use instead of the bundled epanet.exe/swmm5.exe
+    :param swmm_library: path of the SWMM shared library
+    :param timeout: wall-clock seconds a simulation can run before being killed (executables only)
+    :param cpu_limit: CPU seconds a simulation can use before being killed (executables on Linux only)
+    """
+
+    engine = (engine or ENGINE_AUTO).lower()
+    if engine not in (ENGINE_AUTO, ENGINE_EXECUTABLE, ENGINE_TOOLKIT):
+        raise EngineError(f"Unknown engine: {engine}")
+
+    limited = bool(timeout or cpu_limit)
+    if engine == ENGINE_TOOLKIT and limited:
+        raise EngineError("The toolkit engine can't enforce timeout nor cpu_limit. "
+                          "Use engine executable or remove the limits.")
+
+    # SWMM library runs one simulation at a time, so UD batches use the executable unless requested
+    if engine == ENGINE_TOOLKIT or (engine == ENGINE_AUTO and sys.platform != 'win32' and project_type == 'ws'
+                                    and not limited):
+        try:
+            return _get_toolkit_engine(project_type, plugin_dir, swmm_library, timeout, cpu_limit)
+        except EngineError:
+            if engine == ENGINE_TOOLKIT:
+                raise
+
+    opener = shutil.which(executable) or executable if executable else _get_bundled_executable(project_type, plugin_dir)
+    if opener is None:
+        raise EngineError(f"There is no EPA executable for project type '{project_type}'")
+    if not os.path.exists(opener):
+        raise EngineError(f"File not found: {opener}")
+    return SubprocessEngine(opener, timeout, cpu_limit)
+
+
+def _get_toolkit_engine(project_type, plugin_dir, swmm_library, timeout=None, cpu_limit=None):
+
+    if project_type == 'ws':
+        if wntr is None:
+            raise EngineError("Couldn't import WNTR Python package, which is needed to run EPANET toolkit.")
+        return EpanetToolkitEngine(timeout, cpu_limit)
+
+    if project_type == 'ud':
+        library = swmm_library or _find_swmm_library(plugin_dir)
+        if library is None:
+            raise EngineError("SWMM shared library not found.")
+        try:
+            return SwmmLibraryEngine(library, timeout, cpu_limit)
+        except (OSError, AttributeError) as e:
+            raise EngineError(f"Couldn't load SWMM shared library '{library}': {e}")
+
+    raise EngineError(f"There is no EPA toolkit for project type '{project_type}'")
+
+
+if sys.platform == 'win32':
+    _CPU_LIMIT_RETURNCODES = ()
+else:
+    # SIGXCPU when the soft limit is reached, SIGKILL when the hard limit is reached
+    _CPU_LIMIT_RETURNCODES = (-signal.SIGXCPU, -signal.SIGKILL)
+
+
+def _set_cpu_limit(pid, seconds):
+    """ Limit CPU time of process @pid (only on systems with prlimit, e.g. Linux) """
+
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return
+    seconds = max(int(seconds), 1)
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (seconds, seconds + 1))
+    except (OSError, ValueError):
+        pass
+
+
+def _kill_process(process):
+    """ Kill @process and the processes it has started (its process group) """
+
+    try:
+        if sys.platform == 'win32':
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _get_bundled_executable(project_type, plugin_dir):
+
+    if project_type == 'ws':
+        return f"{plugin_dir}{os.sep}resources{os.sep}epa{os.sep}epanet{os.sep}epanet.exe"
+    if project_type == 'ud':
+        return f"{plugin_dir}{os.sep}resources{os.sep}epa{os.sep}swmm{os.sep}swmm5.exe"
+    return None
+
+
+def _find_swmm_library(plugin_dir):
+
+    if sys.platform == 'win32':
+        names = ('swmm5.dll',)
+    elif sys.platform == 'darwin':
+        names = ('libswmm5.dylib',)
+    else:
+        names = ('libswmm5.so', 'libswmm.so')
+
+    if plugin_dir:
+        folder = f"{plugin_dir}{os.sep}resources{os.sep}epa{os.sep}swmm"
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                return path
+
+    return ctypes.util.find_library('swmm5')
@@ -0,0 +1,75 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import os
+import re
+
+_RE_SECTION = re.compile(r'\[(.*?)\]')
+
+# Sections that go to the .gul file (network mode 2) instead of the main INP
+GULLY_TARGETS = ('GULLY', 'LINK', 'GRATE', 'LXSECTIONS')
+
+BUFFER_SIZE = 1024 * 1024
+
+# Section kinds: only main INP, main INP and .gul (TITLE), only .gul
+_MAIN = 0
+_BOTH = 1
+_GULLY = 2
+
+
+def write_inp_files(lines, inp_path, gul_path=None):
+    """ Write INP rows in one pass, splitting them between @inp_path and @gul_path.
+    :param lines: iterable of row texts as returned by gw_fct_pg2epa_main
+    :param gul_path: if set, gully sections (and TITLE) are written to this file. It is only created
+        when one of GULLY_TARGETS sections is found
+    :return: True if the .gul file has been written
+    """
+
+    kind = _BOTH  # Rows before the first section header go to both files
+    gul_file = None
+    gul_pending = []  # Rows to write into .gul file before knowing if it has to be created
+
+    try:
+        with open(inp_path, "w", buffering=BUFFER_SIZE) as inp_file:
+            for text in lines:
+                if text is None:
+                    continue
+
+                if text[:1] == '[' and _RE_SECTION.match(text):
+                    kind = _classify_section(text)
+                    if kind == _GULLY and gul_path is not None and gul_file is None:
+                        gul_file = open(gul_path, "w", buffering=BUFFER_SIZE)
+                        gul_file.writelines(gul_pending)
+                        gul_pending = None
+
+                line = text.rstrip() + "\n"
+                if kind != _GULLY:
+                    inp_file.write(line)
+                if gul_path is None or kind == _MAIN:
+                    continue
+                if gul_file is None:
+                    gul_pending.append(line)
+                else:
+                    gul_file.write(line)
+    finally:
+        if gul_file is not None:
+            gul_file.close()
+
+    # Remove .gul file left by a previous execution without gully sections
+    if gul_path is not None and gul_file is None and os.path.exists(gul_path):
+        os.remove(gul_path)
+
+    return gul_file is not None
+
+
+def _classify_section(text):
+
+    if any(target in text for target in GULLY_TARGETS):
+        return _GULLY
+    if 'TITLE' in text:
+        return _BOTH
+    return _MAIN
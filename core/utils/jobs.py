@@ -0,0 +1,455 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
+from time import sleep, time
+
+from .epa_engines import EngineError, EpaEngine, SimulationCanceled, SimulationTimeout, get_engine
+from .result_cache import get_file_hash
+
+JOB_EXTENSION = ".job"
+LOCK_EXTENSION = ".lock"
+DONE_EXTENSION = ".done"
+
+STATUS_OK = 'ok'
+STATUS_TIMEOUT = 'timeout'
+STATUS_ERROR = 'error'
+
+
+class JobQueue:
+    """ Simulations shared through a folder, so they can be executed by workers on other machines.
+    For every job there are up to three kinds of files:
+    - <name>.job: the INP and RPT files (relative to the folder) and the engine options.
+    - <name>.lock: created with O_EXCL by the worker that claims the job, with a random token that tells it apart
+      from the locks of a later submission of the same job. It is touched while the job runs.
+      Workers never remove nor replace a stale lock: it is taken over creating the next generation
+      (<name>.lock.1, <name>.lock.2...) with O_EXCL, so only one worker can take over each generation.
+      The job belongs to the worker of the highest generation.
+    - <name>.done: the status of the simulation, written once the RPT file is complete.
+    Files are written to a temporary name and renamed, so they are never read half written.
+    """
+
+    def __init__(self, folder):
+
+        self.folder = folder
+        # Lock files held by this process: {job name: (path, token written in it)}
+        self._locks = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def submit(self, name, file_inp, file_rpt, **options):
+        """ Publish job @name. Files left for the same name by an aborted run (job, locks, result and RPT file)
+        are removed first, so no worker skips the new job because of an old lock and no old RPT file is read.
+        The old job is withdrawn before anything else, so no worker can claim it while the rest is removed
+        """
+
+        job = {
+            "name": name,
+            "inp": self._get_relative_path(file_inp),
+            "rpt": self._get_relative_path(file_rpt),
+            "inp_hash": get_file_hash(file_inp),
+            "created": round(time(), 3),
+        }
+        job.update(options)
+        self._remove(name, JOB_EXTENSION)
+        self._remove(name, DONE_EXTENSION)
+        for _, lock in self._get_locks(name):
+            _remove_file(lock)
+        _remove_file(file_rpt)
+        _write_json(self._get_path(name, JOB_EXTENSION), job)
+        return job
+
+    def read_job(self, name):
+        return _read_json(self._get_path(name, JOB_EXTENSION))
+
+    def get_result(self, name):
+        """ Contents of the .done file of @name, or None if the job hasn't finished """
+        return _read_json(self._get_path(name, DONE_EXTENSION))
+
+    def get_file(self, job, key):
+        """ Absolute path of the file @key ('inp' or 'rpt') of @job """
+        return os.path.normpath(os.path.join(self.folder, job[key]))
+
+    def iter_pending(self, stale_after=None):
+        """ Names of the jobs that haven't been claimed nor finished, oldest first.
+        With @stale_after, also the jobs whose lock hasn't been touched for that many seconds
+        """
+
+        try:
+            files = os.listdir(self.folder)
+        except FileNotFoundError:
+            return
+        files = set(files)
+        locks = _get_lock_files(files)
+        jobs = []
+        for file in files:
+            name, extension = os.path.splitext(file)
+            if extension != JOB_EXTENSION:
+                continue
+            if name + DONE_EXTENSION in files:
+                continue
+            if name in locks and not self._is_stale(max(locks[name])[1], stale_after):
+                continue
+            jobs.append(name)
+        yield from sorted(jobs, key=lambda name: self._get_mtime(name, JOB_EXTENSION))
+
+    def claim(self, name, stale_after=None):
+        """ Lock job @name for this worker. Returns False if another worker has it.
+        :param stale_after: seconds after which a lock that isn't touched is taken over
+            (its worker is assumed to be dead)
+        """
+
+        locks = self._get_locks(name)
+        generation = 0
+        if locks:
+            generation, lock = locks[-1]
+            if not self._is_stale(lock, stale_after):
+                return False
+            # Workers that found the same stale lock race for the same generation
+            generation += 1
+
+        path = self._get_lock_path(name, generation)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, "w") as file:
+            json.dump({"worker": _get_worker_id(), "time": round(time(), 3), "token": token}, file)
+        self._locks[name] = (path, token)
+
+        # The job may have finished between listing and locking
+        if self.get_result(name) is not None or not os.path.exists(self._get_path(name, JOB_EXTENSION)):
+            self.release(name)
+            return False
+        return True
+
+    def touch(self, name):
+        try:
+            os.utime(self._locks[name][0])
+        except (KeyError, OSError):
+            pass
+
+    def release(self, name):
+        """ Unlock job @name without finishing it, so another worker can take it.
+        Stale generations below the one of this worker are removed too """
+
+        path, token = self._locks.pop(name, (None, None))
+        if path is None:
+            return
+        # The job was submitted again (see submit), so the locks belong to the new submission
+        lock = _read_json(path)
+        if lock is None or lock.get("token") != token:
+            return
+        locks = [lock for _, lock in self._get_locks(name)]
+        if path not in locks:
+            return
+        for lock in locks[:locks.index(path) + 1]:
+            _remove_file(lock)
+
+    def complete(self, name, job, status, message=None, seconds=None, returncode=None):
+
+        result = {
+            "name": name,
+            "status": status,
+            "inp_hash": job.get("inp_hash"),
+            "worker": _get_worker_id(),
+            "seconds": None if seconds is None else round(seconds, 3),
+            "message": message,
+            "returncode": returncode,
+        }
+        _write_json(self._get_path(name, DONE_EXTENSION), result)
+        self.release(name)
+
+    def withdraw(self, name):
+        """ Remove job @name if no worker has claimed it. Returns False if it is running """
+
+        if not self.claim(name):
+            return False
+        self._remove(name, JOB_EXTENSION)
+        self.release(name)
+        return True
+
+    def _get_path(self, name, extension):
+        return os.path.join(self.folder, name + extension)
+
+    def _get_lock_path(self, name, generation):
+        path = self._get_path(name, LOCK_EXTENSION)
+        return f"{path}.{generation}" if generation else path
+
+    def _get_locks(self, name):
+        """ [(generation, path)] of the lock files of @name, from the oldest generation """
+
+        try:
+            files = os.listdir(self.folder)
+        except FileNotFoundError:
+            return []
+        locks = _get_lock_files(files).get(name, [])
+        return [(generation, os.path.join(self.folder, file)) for generation, file in sorted(locks)]
+
+    def _is_stale(self, lock, stale_after):
+        if not stale_after:
+            return False
+        try:
+            return time() - os.path.getmtime(os.path.join(self.folder, lock)) > stale_after
+        except OSError:
+            return False
+
+    def _get_relative_path(self, path):
+        # Paths are relative to the folder, which may be mounted in a different path by every worker
+        try:
+            return os.path.relpath(path, self.folder)
+        except ValueError:
+            # Different drive on Windows
+            return os.path.abspath(path)
+
+    def _get_mtime(self, name, extension, default=0):
+        try:
+            return os.path.getmtime(self._get_path(name, extension))
+        except OSError:
+            return default
+
+    def _remove(self, name, extension):
+        _remove_file(self._get_path(name, extension))
+
+
+class JobEngine(EpaEngine):
+    """ Engine that doesn't simulate: it submits every INP file to a JobQueue and waits for a worker
+    (see run_worker) to write its RPT file. A single thread follows all the submitted jobs (see submit)
+    """
+
+    name = 'jobs'
+    # Enforced by the workers, if their engine supports them
+    supports_limits = True
+
+    def __init__(self, queue, project_type, engine=None, timeout=None, cpu_limit=None, poll_interval=1.0):
+        super().__init__(timeout, cpu_limit)
+        self.queue = queue
+        self.project_type = project_type
+        self.engine = engine
+        self.poll_interval = poll_interval
+        # Jobs followed by the poller: {name: (future, inp_hash, file_inp, file_rpt)}
+        self._waiting = {}
+        self._lock = Lock()
+        self._poller = None
+
+    @property
+    def version(self):
+        return f"{self.name}:{self.engine or ''}"
+
+    def run(self, file_inp, file_rpt):
+        return self.submit(file_inp, file_rpt).result()
+
+    def submit(self, file_inp, file_rpt):
+        """ Submit @file_inp and return a Future that is resolved with the return code of the simulation
+        when a worker has written @file_rpt.
+        No thread waits for every job: one poller thread checks all of them every poll_interval seconds
+        """
+
+        future = Future()
+        try:
+            self._check_canceled()
+            name = os.path.splitext(os.path.basename(file_inp))[0]
+
+            # A worker may have finished it after the previous execution was canceled
+            inp_hash = get_file_hash(file_inp)
+            result = self.queue.get_result(name)
+            if self._is_valid(result, inp_hash, file_rpt):
+                self._finish(future, result, file_inp)
+                return future
+            self._submit(name, file_inp, file_rpt)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+
+        with self._lock:
+            self._waiting[name] = (future, inp_hash, file_inp, file_rpt)
+            if self._poller is None:
+                self._poller = Thread(target=self._poll, name="jobs-poller", daemon=True)
+                self._poller.start()
+        return future
+
+    def _poll(self):
+
+        while True:
+            sleep(self.poll_interval)
+            with self._lock:
+                if not self._waiting:
+                    self._poller = None
+                    return
+                waiting = list(self._waiting.items())
+
+            for name, (future, inp_hash, file_inp, file_rpt) in waiting:
+                if self.canceled:
+                    self.queue.withdraw(name)
+                    result = SimulationCanceled("Simulation canceled")
+                else:
+                    result = self.queue.get_result(name)
+                    if result is None:
+                        continue
+                    if result.get("inp_hash") != inp_hash:
+                        # Late result of a previous version of the INP file
+                        self._submit(name, file_inp, file_rpt)
+                        continue
+                with self._lock:
+                    del self._waiting[name]
+                self._finish(future, result, file_inp)
+
+    def _finish(self, future, result, file_inp):
+
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        elif result["status"] == STATUS_TIMEOUT:
+            future.set_exception(SimulationTimeout(result.get("message") or
+                                                   f"Simulation exceeded its time limit: {file_inp}"))
+        elif result["status"] != STATUS_OK:
+            future.set_exception(EngineError(f"Simulation failed in worker {result.get('worker')}: "
+                                             f"{result.get('message')}"))
+        else:
+            future.set_result(result.get("returncode") or 0)
+
+    def _submit(self, name, file_inp, file_rpt):
+        self.queue.submit(name, file_inp, file_rpt, project_type=self.project_type, engine=self.engine,
+                          timeout=self.timeout, cpu_limit=self.cpu_limit)
+
+    def _is_valid(self, result, inp_hash, file_rpt):
+        return (result is not None and result["status"] == STATUS_OK and result.get("inp_hash") == inp_hash
+                and os.path.exists(file_rpt))
+
+
+def run_worker(folder, max_workers=1, plugin_dir=None, engine=None, executable=None, swmm_library=None,
+               stale_after=None, exit_when_empty=False, poll_interval=5.0, log=print):
+    """ Claim jobs of the JobQueue in @folder and simulate them until it is stopped (Ctrl+C)
+    or, with @exit_when_empty, until there are no pending jobs. Returns the number of jobs executed.
+    :param engine, executable, swmm_library: override the engine of the jobs, whose paths are
+        the ones of the machine that submitted them
+    """
+
+    queue = JobQueue(folder)
+    slots = BoundedSemaphore(max_workers)
+    engines = {}
+    running = set()
+    lock = Lock()
+    executed = 0
+
+    def get_job_engine(job):
+        key = (job.get("project_type"), engine or job.get("engine"), job.get("timeout"), job.get("cpu_limit"))
+        with lock:
+            if key not in engines:
+                engines[key] = get_engine(key[0], key[1], plugin_dir=plugin_dir, executable=executable,
+                                          swmm_library=swmm_library, timeout=key[2], cpu_limit=key[3])
+            return engines[key]
+
+    def execute(name, job):
+        nonlocal executed
+        t0 = time()
+        try:
+            returncode = get_job_engine(job).run(queue.get_file(job, "inp"), queue.get_file(job, "rpt"))
+        except SimulationCanceled:
+            queue.release(name)
+            return
+        except SimulationTimeout as e:
+            queue.complete(name, job, STATUS_TIMEOUT, str(e), time() - t0)
+        except Exception as e:
+            queue.complete(name, job, STATUS_ERROR, f"{type(e).__name__}: {e}", time() - t0)
+        else:
+            queue.complete(name, job, STATUS_OK, seconds=time() - t0, returncode=returncode)
+        finally:
+            with lock:
+                running.discard(name)
+            slots.release()
+        with lock:
+            executed += 1
+        log(f"{name}: {queue.get_result(name)['status']} ({time() - t0:.1f}s)")
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            submitted = False
+            for name in queue.iter_pending(stale_after):
+                if not slots.acquire(blocking=False):
+                    break
+                job = queue.read_job(name) if queue.claim(name, stale_after) else None
+                if job is None:
+                    slots.release()
+                    continue
+                with lock:
+                    running.add(name)
+                executor.submit(execute, name, job)
+                submitted = True
+
+            with lock:
+                for name in running:
+                    queue.touch(name)
+                idle = not running
+            if exit_when_empty and idle and not submitted:
+                break
+            sleep(0.1 if submitted else poll_interval)
+    except KeyboardInterrupt:
+        log("Stopping worker. Running jobs are released for other workers.")
+        with lock:
+            for job_engine in engines.values():
+                job_engine.cancel()
+    finally:
+        executor.shutdown(wait=True)
+
+    return executed
+
+
+def _get_lock_files(files):
+    """ {job name: [(generation, file)]} of the lock files in @files """
+
+    locks = {}
+    for file in files:
+        base, extension = os.path.splitext(file)
+        if extension == LOCK_EXTENSION:
+            locks.setdefault(base, []).append((0, file))
+            continue
+        name, lock_extension = os.path.splitext(base)
+        if lock_extension == LOCK_EXTENSION and extension[1:].isdigit():
+            locks.setdefault(name, []).append((int(extension[1:]), file))
+    return locks
+
+
+def _get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _get_worker_suffix():
+    # Valid in file names
+    return _get_worker_id().replace(':', '-')
+
+
+def _read_json(path):
+
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_file(path):
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_json(path, values):
+
+    tmp_path = f"{path}.{_get_worker_suffix()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(values, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,109 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import json
+import os
+from threading import Lock
+from time import time
+
+from .result_cache import get_file_hash
+
+STAGE_EXPORTED = 'exported'
+STAGE_SIMULATED = 'simulated'
+STAGE_IMPORTED = 'imported'
+STAGES = (STAGE_EXPORTED, STAGE_SIMULATED, STAGE_IMPORTED)
+
+
+class RunManifest:
+    """ Journal of the stages completed by every scenario of a batch, used to resume it.
+    Every completed stage is appended as one JSON line, so nothing is lost if QGIS is closed in the middle.
+    The first line identifies the config file: a journal written with other lists can't be resumed.
+    """
+
+    def __init__(self, file_path, config_hash, resume=False):
+
+        self.file_path = file_path
+        self.config_hash = config_hash
+        self.scenarios = {}
+        self.resumed = False
+        self._lock = Lock()
+
+        if resume and os.path.exists(file_path):
+            self.resumed = self._load()
+        if self.resumed:
+            self._file = open(file_path, "a", buffering=1)
+        else:
+            self.scenarios = {}
+            self._file = open(file_path, "w", buffering=1)
+            self._file.write(json.dumps({"config": config_hash, "created": round(time(), 3)}) + "\n")
+
+    def get_stage(self, scenario):
+        """ Last completed stage of @scenario, or None """
+
+        with self._lock:
+            values = self.scenarios.get(scenario)
+        return values.get('stage') if values else None
+
+    def get_resume_stage(self, scenario, file_inp, file_rpt):
+        """ Last completed stage of @scenario whose files are still valid: the INP file must be the one
+        that was exported, and the RPT file must exist to skip the simulation """
+
+        with self._lock:
+            values = dict(self.scenarios.get(scenario, {}))
+        stage = values.get('stage')
+        if stage is None or stage == STAGE_IMPORTED:
+            return stage
+
+        try:
+            if get_file_hash(file_inp) != values.get('inp_hash'):
+                return None
+        except OSError:
+            return None
+        if stage == STAGE_SIMULATED and not os.path.exists(file_rpt):
+            return STAGE_EXPORTED
+        return stage
+
+    def mark(self, scenario, stage, **values):
+        """ Record that @scenario has completed @stage """
+
+        line = {"scenario": scenario, "stage": stage, "time": round(time(), 3)}
+        line.update(values)
+        with self._lock:
+            self.scenarios.setdefault(scenario, {}).update(line)
+            if self._file is not None:
+                self._file.write(json.dumps(line) + "\n")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def mark_exported(self, scenario, file_inp):
+        self.mark(scenario, STAGE_EXPORTED, inp_hash=get_file_hash(file_inp))
+
+    def close(self):
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self):
+
+        try:
+            with open(self.file_path) as file:
+                header = json.loads(file.readline() or "{}")
+                if header.get('config') != self.config_hash:
+                    return False
+                for line in file:
+                    try:
+                        values = json.loads(line)
+                    except ValueError:
+                        # Last line may be incomplete if the process was killed while writing it
+                        continue
+                    self.scenarios.setdefault(values['scenario'], {}).update(values)
+        except (OSError, ValueError, KeyError):
+            self.scenarios = {}
+            return False
+        return True
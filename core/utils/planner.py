@@ -0,0 +1,161 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import json
+import os
+from datetime import date, timedelta
+from itertools import islice
+from threading import Lock
+
+from .scenarios import TRAVERSAL_NESTED, count_scenarios, get_result_name, iter_scenarios
+
+HISTORY_FILE = 'epa_multi_calls_history.json'
+
+# Phases that write the files kept in the output folder
+_INP_PHASE = 'inp_write'
+_RPT_PHASE = 'simulation'
+
+_file_lock = Lock()
+
+
+class BatchPlan:
+    """ What an Epa Multi Calls batch will do, computed from the config file only (without the database).
+    Disk usage and runtime are estimated from @history, the record of a previous batch of the same project
+    """
+
+    def __init__(self, levels, prefix, history=None, traversal=TRAVERSAL_NESTED):
+
+        self.levels = levels
+        self.prefix = prefix
+        self.history = history
+        self.traversal = traversal
+        self.scenarios = count_scenarios(levels)
+
+    @property
+    def bytes_per_scenario(self):
+        """ Mean size of the INP and RPT files of one scenario """
+
+        if not self.history:
+            return None
+        phases = self.history.get('phases', {})
+        sizes = [phases.get(phase, {}).get('bytes_mean') for phase in (_INP_PHASE, _RPT_PHASE)]
+        if not any(sizes):
+            return None
+        return sum(size for size in sizes if size)
+
+    @property
+    def disk_usage(self):
+
+        size = self.bytes_per_scenario
+        return None if size is None else size * self.scenarios
+
+    @property
+    def seconds_per_scenario(self):
+        """ Wall time of one scenario, including the overlap of exports, simulations and imports """
+
+        if not self.history or not self.history.get('scenarios'):
+            return None
+        return self.history['wall_time'] / self.history['scenarios']
+
+    @property
+    def runtime(self):
+
+        seconds = self.seconds_per_scenario
+        return None if seconds is None else seconds * self.scenarios
+
+    def iter_result_names(self):
+        """ Result names of all scenarios, in the order they will be exported """
+
+        for states, _ in iter_scenarios(self.levels, self.traversal):
+            yield get_result_name(self.prefix, [level.get_value(state) for level, state in zip(self.levels, states)])
+
+    def get_text(self, max_names=5):
+        """ Report shown before executing the batch """
+
+        lines = [f"Scenarios (INP files): {self.scenarios}"]
+        for level in self.levels:
+            lines.append(f"[list{level.number}]: {len(level)} values, {len(level.queries)} queries")
+
+        if self.history:
+            lines.append(f"Disk usage: {format_size(self.disk_usage)}")
+            runtime = self.runtime
+            runtime = "unknown" if runtime is None else str(timedelta(seconds=round(runtime)))
+            lines.append(f"Estimated time: {runtime}")
+            lines.append(f"(estimated from {self.history['scenarios']} scenarios executed on {self.history['date']})")
+            phases = self.history.get('phases', {})
+            if phases:
+                slowest = sorted(phases.items(), key=lambda item: item[1]['mean'], reverse=True)[:3]
+                lines.append("Slowest phases (mean): " +
+                             ", ".join(f"{phase} {values['mean']:.2f}s" for phase, values in slowest))
+        else:
+            lines.append("Disk usage and time will be estimated once a batch of this project has been executed.")
+
+        names = list(islice(self.iter_result_names(), max_names + 1))
+        if names:
+            more = ", ..." if len(names) > max_names else ""
+            lines.append(f"Results: {', '.join(names[:max_names])}{more}")
+
+        return "\n".join(lines)
+
+
+def format_size(size):
+
+    if size is None:
+        return "unknown"
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def get_history_key(project_file, config_file):
+    """ Batches are grouped by QGIS project, or by config file if the project hasn't been saved """
+    return project_file or config_file
+
+
+def get_history_file(*folders):
+
+    if not all(folders):
+        return None
+    return os.path.join(*folders, HISTORY_FILE)
+
+
+def load_history(history_file, key):
+    """ Record of the last batch of @key, as saved by save_history """
+
+    if not history_file or not key or not os.path.exists(history_file):
+        return None
+    try:
+        with _file_lock, open(history_file) as file:
+            return json.load(file).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_history(history_file, key, summary, scenarios):
+    """ Save the timings @summary (see PhaseTimer.summary) of a batch of @scenarios scenarios """
+
+    if not history_file or not key or not scenarios:
+        return
+    record = {
+        "date": date.today().isoformat(),
+        "scenarios": scenarios,
+        "wall_time": summary["wall_time"],
+        "phases": summary["phases"],
+    }
+    try:
+        with _file_lock:
+            values = {}
+            if os.path.exists(history_file):
+                with open(history_file) as file:
+                    values = json.load(file)
+            values[key] = record
+            with open(history_file, "w") as file:
+                json.dump(values, file, indent=2)
+    except (OSError, ValueError):
+        pass
@@ -0,0 +1,64 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+def create_process_pool(max_workers, initializer=None, initargs=()):
+    """ Create a ProcessPoolExecutor that can be used from inside QGIS.
+    QGIS runs many threads, so workers are never forked from it: a fork can copy a lock held by
+    another thread (logging, psycopg2, Qt) and deadlock the worker. On Linux workers are forked
+    from a fork server, a clean Python process started once; elsewhere they are spawned.
+    In QGIS sys.executable is the QGIS binary, so both use the Python interpreter of the QGIS installation.
+    Functions and arguments sent to the pool must be picklable and live in modules that don't import qgis (core/utils)
+    """
+
+    if sys.platform.startswith('linux'):
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+    python = get_python_executable()
+    if python:
+        context.set_executable(python)
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                               initializer=initializer, initargs=initargs)
+
+
+def get_python_executable():
+    """ Find the Python interpreter bundled with QGIS """
+
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+
+    if sys.platform == 'win32':
+        names = ('pythonw.exe', 'python.exe', f'python{sys.version_info.major}.exe')
+        folders = (sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin'))
+    else:
+        names = (f'python{sys.version_info.major}.{sys.version_info.minor}', f'python{sys.version_info.major}')
+        folders = (os.path.join(sys.exec_prefix, 'bin'), os.path.dirname(sys.executable))
+
+    for folder in folders:
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                return path
+
+    return None
+
+
+def get_max_workers(value, default=0):
+    """ Parse a worker count option. 'auto' means one worker per CPU """
+
+    if value is None or str(value).strip() == '':
+        return default
+    if str(value).strip().lower() == 'auto':
+        return os.cpu_count() or 1
+    return max(int(value), 0)
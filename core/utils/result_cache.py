@@ -0,0 +1,131 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import uuid
+from threading import Lock
+
+CACHE_EXTENSION = ".rpt"
+
+
+class ResultCache:
+    """ Persistent cache of RPT files, addressed by the content of the INP file and the EPA engine.
+    Least recently used files are removed when the cache grows over @max_size bytes
+    """
+
+    def __init__(self, folder, max_size=None):
+
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._size = None
+        os.makedirs(folder, exist_ok=True)
+
+    def get_key(self, file_inp, engine_version=""):
+        """ Hash of @file_inp and @engine_version. Comment lines (';') are ignored,
+        because they hold the result name and the export date but don't change the simulation
+        """
+
+        sha = hashlib.sha256()
+        sha.update(f"{engine_version}\n".encode("utf-8"))
+        with open(file_inp, "rb") as file:
+            for line in file:
+                if line.lstrip().startswith(b";"):
+                    continue
+                sha.update(line)
+        return sha.hexdigest()
+
+    def fetch(self, key, file_rpt):
+        """ Copy cached result @key into @file_rpt. Returns False if it isn't cached """
+
+        path = self._get_path(key)
+        try:
+            shutil.copyfile(path, file_rpt)
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, file_rpt):
+        """ Save @file_rpt as result of @key """
+
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Copy to a temporary name first, so other processes never read a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(file_rpt, tmp_path)
+        size = os.path.getsize(tmp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size - old_size
+            self._evict()
+
+    def get_size(self):
+        """ Total size in bytes of cached files """
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            return self._size
+
+    def _evict(self):
+
+        if self.max_size is None:
+            return
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._scan())
+        if self._size <= self.max_size:
+            return
+
+        for path, size, _ in sorted(self._scan(), key=lambda item: item[2]):
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def _scan(self):
+        """ Yield (path, size, last use) of cached files """
+
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if not name.endswith(CACHE_EXTENSION):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _get_path(self, key):
+        return os.path.join(self.folder, key[:2], f"{key}{CACHE_EXTENSION}")
+
+
+def get_file_hash(path):
+    """ sha256 of a whole file (used as version of the EPA executables) """
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -0,0 +1,249 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import os
+import re
+
+# Precompiled tokenizers (same expressions used by the former line-by-line parser)
+_RE_SPLIT_NUMBER = re.compile(r'[0-9][-]\d{1,2}[.]]*')
+_RE_OVERLAPPED = re.compile(r'(\d\..*\.\d)')
+_RE_TIME = re.compile(r'^([012]?[0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]$')
+
+PROGRESS_STEP = 1000
+
+
+class RptParseError(Exception):
+    """ Raised when a report file can't be imported """
+
+    def __init__(self, message, line_number=None):
+        super().__init__(message)
+        self.line_number = line_number
+
+    def __reduce__(self):
+        # Keep line number when the error is sent back from a worker process
+        return RptParseError, (str(self), self.line_number)
+
+
+def get_rpt_sources(rows):
+    """ Build dict {target: (position, tablename)} from config_fprocess rows (tablename, target).
+    Each value is stored with its position so that, when two targets match the same line,
+    the last one defined wins (as it happened when all sources were scanned for every line)
+    """
+
+    sources = {}
+    for tablename, targets in rows or []:
+        json_elem = targets.replace('{', '').replace('}', '')
+        for target in json_elem.split(','):
+            target = target.strip()
+            position = sources[target][0] if target in sources else len(sources)
+            sources[target] = (position, tablename.strip())
+    return sources
+
+
+def iter_rpt_rows(file_path, sources, project_type, progress=None):
+    """ Stream @file_path line by line and yield one tuple (target, col40, columns) per imported line.
+    :param sources: dict returned by get_rpt_sources
+    :param progress: optional callable receiving an approximate percentage every PROGRESS_STEP lines
+    """
+
+    total_size = os.path.getsize(file_path) or 1
+    read_size = 0
+    target = "null"
+    col40 = "null"
+    is_ud = project_type == 'ud'
+
+    with open(file_path, "r") as file_rpt:
+        for line_number, row in enumerate(file_rpt, 1):
+            read_size += len(row)
+            if progress is not None and line_number % PROGRESS_STEP == 0:
+                progress(min(read_size * 100 / total_size, 100))
+
+            if '**' in row or '--' in row:
+                continue
+
+            if is_ud and '>50' in row:
+                row = row.replace('>50', '50')
+
+            dirty_list = [item for item in row.rstrip().split(' ') if item != '']
+            if not dirty_list:
+                continue
+
+            sp_n = _split_tokens(dirty_list, line_number)
+            if not sp_n:
+                continue
+
+            # Find strings into dict and set target column
+            if len(sp_n) > 1:
+                match = _match_source(sources, f'{sp_n[0]} {sp_n[1]}', sp_n[0])
+                if match is not None:
+                    target = "'" + match + "'"
+                    if len(sp_n) > 3 and _RE_TIME.search(sp_n[3]):
+                        col40 = "'" + sp_n[3] + "'"
+
+            yield target, col40, sp_n
+
+
+def rows_to_json(rows):
+    """ Serialize rows yielded by iter_rpt_rows into the JSON array expected by gw_fct_rpt2pg_main """
+
+    return '[' + ', '.join(row_to_json(*row) for row in rows) + ']'
+
+
+def parse_rpt_file(file_path, sources, project_type, progress=None):
+    """ Parse the whole report and return its JSON representation """
+
+    return rows_to_json(iter_rpt_rows(file_path, sources, project_type, progress))
+
+
+def _split_tokens(dirty_list, line_number):
+
+    sp_n = []
+    for item in dirty_list:
+        if _RE_SPLIT_NUMBER.search(item):
+            last_index = 0
+            i = 0
+            for i, c in enumerate(item):
+                if c == "-":
+                    sp_n.append(item[last_index:i])
+                    last_index = i
+            sp_n.append(item[last_index:i])
+
+        elif _RE_OVERLAPPED.search(item):
+            if 'Version' not in dirty_list and 'VERSION' not in dirty_list:
+                error_near = f"Error near line {line_number} -> {dirty_list}"
+                message = (f"The rpt file is not valid to import. "
+                           f"Because columns on rpt file are overlaped, it seems you need to improve your simulation. "
+                           f"Please ckeck and fix it before continue. \n"
+                           f"{error_near}")
+                raise RptParseError(message, line_number)
+        elif '>50' in item:
+            error_near = f"Error near line {line_number} -> {dirty_list}"
+            message = (f"The rpt file is not valid to import. "
+                       f"Because velocity has not numeric value (>50), it seems you need to improve your simulation. "
+                       f"Please ckeck and fix it before continue. \n"
+                       f"{error_near}")
+            raise RptParseError(message, line_number)
+        else:
+            sp_n.append(item)
+
+    return sp_n
+
+
+def _match_source(sources, two_words, one_word):
+
+    first = sources.get(two_words)
+    second = sources.get(one_word)
+    if first is None:
+        return second[1] if second is not None else None
+    if second is None or first[0] > second[0]:
+        return first[1]
+    return second[1]
+
+
+def row_to_json(target, col40, columns):
+    """ Serialize one row yielded by iter_rpt_rows """
+
+    parts = [f'"target": "{target}", "col40": "{col40}"']
+    for x, value in enumerate(columns, 1):
+        if "''" in value:
+            parts.append(f'"col{x}":null')
+        else:
+            parts.append(f'"col{x}":"{value.strip()}"')
+    return '{' + ', '.join(parts) + '}'
+
+
+# region COPY
+# Staging table used to import rpt files with COPY instead of sending them inside the JSON body
+COPY_TABLE = "temp_rpt2pg_copy"
+COPY_COLUMNS = 39  # col40 is reserved for the time of the results
+
+_COPY_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def get_copy_table_sql():
+    """ SQL to create the (session scoped) staging table """
+
+    columns = ", ".join(f"col{x} text" for x in range(1, COPY_COLUMNS + 1))
+    return (f"CREATE TEMP TABLE IF NOT EXISTS {COPY_TABLE} "
+            f"(result_id text, line_id integer, target text, col40 text, {columns});")
+
+
+def get_copy_sql():
+    """ COPY statement matching lines generated by iter_copy_lines """
+
+    columns = ", ".join(f"col{x}" for x in range(1, COPY_COLUMNS + 1))
+    return f"COPY {COPY_TABLE} (result_id, line_id, target, col40, {columns}) FROM STDIN"
+
+
+def get_copy_json_sql(result_id_literal):
+    """ Subquery that rebuilds, server side, the JSON array that gw_fct_rpt2pg_main expects.
+    The import function is unchanged and still receives the whole report as JSON: COPY only saves
+    building, sending and parsing it on the client
+    """
+
+    columns = ", ".join(f"'col{x}', col{x}" for x in range(1, COPY_COLUMNS + 1))
+    return (f"(SELECT COALESCE(json_agg(json_strip_nulls(json_build_object("
+            f"'target', target, 'col40', col40, {columns})) ORDER BY line_id), '[]'::json) "
+            f"FROM {COPY_TABLE} WHERE result_id = {result_id_literal})")
+
+
+def iter_copy_lines(rows, result_id):
+    """ Convert rows yielded by iter_rpt_rows into lines of COPY text format.
+    Rows with more than COPY_COLUMNS values don't fit in the staging table and raise RptParseError
+    """
+
+    result_id = _copy_value(result_id)
+    empty = ['\\N'] * COPY_COLUMNS
+    for line_id, (target, col40, columns) in enumerate(rows, 1):
+        if len(columns) > COPY_COLUMNS:
+            raise RptParseError(f"Line with {len(columns)} values for '{target}', the staging table "
+                                f"only has {COPY_COLUMNS} columns. Use rpt_import=json.")
+        values = [r'\N' if "''" in value else _copy_value(value.strip()) for value in columns]
+        values += empty[len(values):]
+        yield f"{result_id}\t{line_id}\t{_copy_value(target)}\t{_copy_value(col40)}\t" + "\t".join(values) + "\n"
+
+
+def write_copy_file(file_path, sources, project_type, result_id, copy_path):
+    """ Parse the report into a COPY file (used by worker processes). Returns @copy_path """
+
+    rows = iter_rpt_rows(file_path, sources, project_type)
+    with open(copy_path, "w", buffering=1024 * 1024) as copy_file:
+        copy_file.writelines(iter_copy_lines(rows, result_id))
+    return copy_path
+
+
+class CopyStream:
+    """ File-like object over an iterable of lines, to be used with cursor.copy_expert """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+
+        data = ''.join(chunks)
+        if size < 0 or len(data) <= size:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def _copy_value(value):
+    return value.translate(_COPY_ESCAPE)
+
+# endregion
@@ -0,0 +1,205 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import math
+from threading import Lock
+
+TRAVERSAL_GRAY = 'gray'
+TRAVERSAL_NESTED = 'nested'
+LIST_QUERIES_TEXT = 'text'
+LIST_QUERIES_PREPARED = 'prepared'
+
+
+class ScenarioLevel:
+    """ One [listN] section of the Epa Multi Calls config file.
+    Every value of every list{i} is a state of the level, applied by executing its query{i}
+    """
+
+    def __init__(self, number, queries, lists):
+
+        self.number = number
+        self.queries = queries
+        self.lists = lists
+        self.states = [(idx, value) for idx, values in enumerate(lists) for value in values]
+
+    def __len__(self):
+        return len(self.states)
+
+    @property
+    def placeholder(self):
+        return f"$list{self.number}object"
+
+    def get_value(self, state):
+        return self.states[state][1]
+
+    def get_query(self, state):
+        """ Query that sets the level to @state """
+
+        idx, value = self.states[state]
+        return self.queries[idx].replace(self.placeholder, value)
+
+
+class PreparedQueries:
+    """ Executes the queries of the lists as prepared statements, with the value of the list bound as a parameter.
+    PostgreSQL parses and plans every query once per database session instead of once per scenario,
+    and values don't have to be quoted. Queries that can't be prepared (see get_prepared_statement)
+    are executed with the placeholder replaced, as usual.
+    """
+
+    def __init__(self, levels):
+
+        self.statements = {}  # (level number, query index): statement with $1, or None
+        for level in levels:
+            for idx, query in enumerate(level.queries):
+                self.statements[(level.number, idx)] = get_prepared_statement(query, level.placeholder)
+        self._sessions = {}  # Names prepared in every database session
+        self._lock = Lock()
+
+    def get_unprepared(self):
+        """ Names (listN/queryI) of the queries that are executed as text """
+        return [f"list{number}/query{idx + 1}" for (number, idx), statement in self.statements.items()
+                if statement is None]
+
+    def execute(self, cursor, level, state):
+        """ Set @level to @state with @cursor (psycopg2). The transaction isn't committed """
+
+        idx, value = level.states[state]
+        statement = self.statements[(level.number, idx)]
+        if statement is None:
+            cursor.execute(level.get_query(state))
+            return
+
+        # Prepared statements belong to the session, so they are prepared again after reconnecting
+        conn = cursor.connection
+        with self._lock:
+            prepared = self._sessions.setdefault((id(conn), conn.get_backend_pid()), set())
+        name = f"gw_list{level.number}_query{idx + 1}"
+        if name not in prepared:
+            cursor.execute(f"PREPARE {name} AS {statement}")
+            prepared.add(name)
+        cursor.execute(f"EXECUTE {name} (%s)", (value,))
+
+
+def get_prepared_statement(query, placeholder):
+    """ @query with @placeholder replaced by the parameter $1, or None if it can't be prepared:
+    it must be a single statement, and the placeholder must be a value, not part of a quoted literal
+    (e.g. `SET demand = $list1object` instead of `SET demand = '$list1object'`)
+    """
+
+    statement = query.strip().rstrip(';').strip()
+    if placeholder not in statement or ';' in statement or '$$' in statement:
+        return None
+
+    parts = statement.split(placeholder)
+    quote = None  # Quote of the literal or identifier that is open, if any
+    for part in parts[:-1]:
+        for char in part:
+            if quote is None and char in ("'", '"'):
+                quote = char
+            elif char == quote:
+                # A doubled quote inside a literal closes and opens it again
+                quote = None
+        if quote is not None:
+            return None
+    return "$1".join(parts)
+
+
+def read_levels(settings):
+    """ Read sections [list1], [list2]... from @settings (QSettings) until one is missing or empty """
+
+    levels = []
+    number = 1
+    while True:
+        queries = []
+        lists = []
+        i = 1
+        while True:
+            query = settings.value(f"list{number}/query{i}")
+            list_str = settings.value(f"list{number}/list{i}")
+            if not query or not list_str:
+                break
+            if not issubclass(type(list_str), list):
+                list_str = [list_str]
+            queries.append(query)
+            lists.append(list_str)
+            i += 1
+        if not queries:
+            return levels
+        levels.append(ScenarioLevel(number, queries, lists))
+        number += 1
+
+
+def read_traversal(settings):
+    """ Option 'traversal' of @settings (QSettings). Unknown values are returned as None """
+
+    traversal = (settings.value("options/traversal") or TRAVERSAL_NESTED).lower()
+    return traversal if traversal in (TRAVERSAL_GRAY, TRAVERSAL_NESTED) else None
+
+
+def count_scenarios(levels):
+    """ Number of scenarios (INP files) generated by @levels """
+
+    if not levels:
+        return 0
+    return math.prod(len(level) for level in levels)
+
+
+def iter_scenarios(levels, traversal=TRAVERSAL_NESTED):
+    """ Lazily enumerate all combinations of level states.
+    Yields (states, changed): the state index of every level and the positions of the levels whose
+    query has to be executed to reach that scenario from the previous one.
+    - gray: reflected mixed-radix Gray code. Each step changes exactly one level.
+    - nested: nested loops (first level outermost), re-applying every inner level when an outer one changes.
+    """
+
+    radices = [len(level) for level in levels]
+    if not radices or 0 in radices:
+        return
+
+    n = len(radices)
+    states = [0] * n
+    yield tuple(states), tuple(range(n))
+
+    if traversal == TRAVERSAL_NESTED:
+        while True:
+            j = n - 1
+            while j >= 0 and states[j] == radices[j] - 1:
+                states[j] = 0
+                j -= 1
+            if j < 0:
+                return
+            states[j] += 1
+            yield tuple(states), tuple(range(j, n))
+
+    directions = [1] * n
+    while True:
+        j = n - 1
+        while j >= 0 and not 0 <= states[j] + directions[j] < radices[j]:
+            directions[j] = -directions[j]
+            j -= 1
+        if j < 0:
+            return
+        states[j] += directions[j]
+        yield tuple(states), (j,)
+
+
+def get_result_name(prefix, values):
+    """ Result name of a scenario: prefix followed by level values, from the innermost to the outermost """
+
+    return f"{prefix}" + "".join(f"-{value}" for value in reversed(values) if value)
+
+
+def get_pending_levels(applied, states, traversal=TRAVERSAL_NESTED):
+    """ Positions of the levels whose query has to be executed to go from @applied to @states (state indexes).
+    Used when scenarios aren't reached one after the other, e.g. when they are shared by several database sessions.
+    A None in @applied means the level hasn't been set yet.
+    """
+
+    pending = [i for i, (old, new) in enumerate(zip(applied, states)) if old != new]
+    if traversal == TRAVERSAL_NESTED and pending:
+        return tuple(range(pending[0], len(states)))
+    return tuple(pending)
@@ -0,0 +1,103 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import json
+import math
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, time
+
+
+class PhaseTimer:
+    """ Records how long every phase of every scenario takes.
+    Each measure is appended as one JSON line to @file_path, so it can be read while the batch is running.
+    Once closed, new measures are ignored (callbacks of simulations canceled at the end of the batch may still run)
+    """
+
+    def __init__(self, file_path=None):
+
+        self.file_path = file_path
+        self.durations = defaultdict(list)
+        self.sizes = defaultdict(list)
+        self.t0 = perf_counter()
+        self._file = None
+        self._lock = Lock()
+        self.closed = False
+        if file_path:
+            self._file = open(file_path, "w", buffering=1)
+
+    @contextmanager
+    def measure(self, scenario, phase, **extra):
+        """ Measure the code inside the with block """
+
+        t0 = perf_counter()
+        try:
+            yield extra
+        finally:
+            self.record(scenario, phase, perf_counter() - t0, **extra)
+
+    def record(self, scenario, phase, seconds, **extra):
+
+        line = {"time": round(time(), 3), "scenario": scenario, "phase": phase, "seconds": round(seconds, 6)}
+        line.update(extra)
+        with self._lock:
+            if self.closed:
+                return
+            self.durations[phase].append(seconds)
+            if extra.get('bytes') is not None:
+                self.sizes[phase].append(extra['bytes'])
+            if self._file is not None:
+                self._file.write(json.dumps(line) + "\n")
+
+    def summary(self):
+        """ Statistics of every phase: count, total, mean, p50, p95 and max (seconds),
+        and mean size of the files written by the phase (bytes), if any """
+
+        phases = {}
+        with self._lock:
+            for phase, values in self.durations.items():
+                values = sorted(values)
+                phases[phase] = {
+                    "count": len(values),
+                    "total": round(sum(values), 6),
+                    "mean": round(sum(values) / len(values), 6),
+                    "p50": round(percentile(values, 50), 6),
+                    "p95": round(percentile(values, 95), 6),
+                    "max": round(values[-1], 6),
+                }
+                sizes = self.sizes.get(phase)
+                if sizes:
+                    phases[phase]["bytes_mean"] = round(sum(sizes) / len(sizes))
+        return {"wall_time": round(perf_counter() - self.t0, 3), "phases": phases}
+
+    def close(self):
+
+        with self._lock:
+            self.closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def percentile(values, percent):
+    """ Percentile of sorted @values using linear interpolation """
+
+    if not values:
+        return 0
+    rank = (len(values) - 1) * percent / 100
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def timed_call(function, *args):
+    """ Call @function and return (result, seconds). Used to measure work done in worker processes """
+
+    t0 = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - t0
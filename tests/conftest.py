@@ -0,0 +1,12 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# The modules of core/utils don't need QGIS, so they are imported directly from the plugin folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,116 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import math
+import random
+from collections import defaultdict
+
+import pytest
+
+from core.utils import demand_check
+from core.utils.demand_check import get_pairs_within, get_pruned_pairs, is_pair_skipped
+
+
+def _baseline_pairs(names, coordinates, max_distance):
+    """ Pairs found by the former _get_initial_pairs of the task, as unordered pairs """
+
+    points = [{"id": name, "x": x, "y": y} for name, (x, y) in zip(names, coordinates)]
+    pairs = set()
+    while points:
+        p1 = points.pop()
+        for p2 in points:
+            dist = math.sqrt((p1["x"] - p2["x"]) ** 2 + (p1["y"] - p2["y"]) ** 2)
+            if dist <= max_distance:
+                pairs.add(frozenset((p1["id"], p2["id"])))
+    return pairs
+
+
+def _get_network(count=300, seed=1):
+    rng = random.Random(seed)
+    names = [f"N{i}" for i in range(count)]
+    coordinates = [(rng.uniform(0, 5000), rng.uniform(0, 5000)) for _ in names]
+    # Nodes on the same coordinates and exactly at the maximum distance
+    coordinates[1] = coordinates[0]
+    coordinates[2] = (coordinates[0][0] + 250, coordinates[0][1])
+    return names, coordinates
+
+
+@pytest.mark.parametrize("search", ["kdtree", "grid", "python"])
+@pytest.mark.parametrize("max_distance", [0, 250, 1000])
+def test_same_pairs_as_baseline(monkeypatch, search, max_distance):
+    if search == "kdtree" and demand_check.cKDTree is None:
+        pytest.skip("SciPy isn't installed")
+    if search in ("kdtree", "grid") and demand_check.np is None:
+        pytest.skip("NumPy isn't installed")
+    if search != "kdtree":
+        monkeypatch.setattr(demand_check, "cKDTree", None)
+    if search == "python":
+        monkeypatch.setattr(demand_check, "np", None)
+    if search == "grid":
+        # Crowded cells are compared in several chunks
+        monkeypatch.setattr(demand_check, "MAX_DISTANCES", 16)
+    names, coordinates = _get_network()
+
+    pairs = get_pairs_within(names, coordinates, max_distance)
+
+    assert {frozenset(pair) for pair in pairs} == _baseline_pairs(names, coordinates, max_distance)
+    # Later node first
+    assert all(names.index(first) > names.index(second) for first, second in pairs)
+
+
+def _get_node_pairs(pairs):
+    node_pairs = defaultdict(set)
+    for pair in pairs:
+        for node_name in pair:
+            node_pairs[node_name].add(pair)
+    return node_pairs
+
+
+def _get_result(simple, doubled):
+    return {"simple": {"status": simple}, "doubled": {"status": doubled}, "paired": {"status": None}}
+
+
+def test_resume_with_timed_out_node():
+    # Partial file of an execution where the simulation of A exceeded the time limit
+    results = {
+        "A": {"error": "Simulation exceeded the time limit."},
+        "B": _get_result("ok", "failed"),
+    }
+    pairs = {("B", "A")}
+    node_pairs = _get_node_pairs(pairs)
+
+    for node_name in results:
+        pairs -= get_pruned_pairs(node_name, results, node_pairs)
+
+    assert pairs == set()
+    assert is_pair_skipped(("B", "A"), results)
+
+
+def test_pruned_pairs():
+    results = {
+        "A": _get_result("ok", "ok"),
+        "B": _get_result("ok", "ok"),
+        "C": _get_result("ok", "failed"),
+        "D": _get_result("failed", "failed"),
+    }
+    node_pairs = _get_node_pairs({("B", "A"), ("C", "A"), ("D", "C")})
+
+    assert get_pruned_pairs("A", results, node_pairs) == {("B", "A")}
+    assert get_pruned_pairs("C", results, node_pairs) == set()
+    assert get_pruned_pairs("D", results, node_pairs) == {("D", "C")}
+    assert get_pruned_pairs("E", {"E": _get_result("failed", "failed")}, node_pairs) == set()
+
+
+def test_pair_skipped():
+    results = {
+        "A": _get_result("ok", "failed"),
+        "B": _get_result("ok", "failed"),
+    }
+    assert not is_pair_skipped(("B", "A"), results)
+
+    results["B"]["paired"]["A"] = {"status": "ok"}
+    assert is_pair_skipped(("B", "A"), results)
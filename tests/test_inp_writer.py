@@ -0,0 +1,106 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import os
+import re
+
+import pytest
+
+from core.utils.inp_writer import write_inp_files
+
+ROWS_GULLY = [
+    ";Giswater export",
+    "[TITLE]",
+    ";Result: result1   ",
+    "[JUNCTIONS]",
+    "J1     95.0",
+    "J2     94.0\t",
+    "[GULLY]",
+    "G1     J1     0.5",
+    "[CONDUITS]",
+    "C1     J1     J2     10",
+    "[LXSECTIONS]",
+    "L1     CIRCULAR     0.3",
+    "[END]",
+]
+
+ROWS_NO_GULLY = [row for row in ROWS_GULLY if row not in ("[GULLY]", "G1     J1     0.5", "[LXSECTIONS]",
+                                                              "L1     CIRCULAR     0.3")]
+
+
+def _baseline_fill_inp_file(folder_path, all_rows, gully):
+    """ Files written by the former _fill_inp_file of the task. @gully: UD project with network mode 2 """
+
+    file_inp = open(folder_path, "w")
+    read = True
+    for row in all_rows:
+        if bool(re.match(r'\[(.*?)\]', row['text'])) and \
+                ('GULLY' in row['text'] or 'LINK' in row['text'] or
+                 'GRATE' in row['text'] or 'LXSECTIONS' in row['text']):
+            read = False
+        elif bool(re.match(r'\[(.*?)\]', row['text'])):
+            read = True
+        if 'text' in row and row['text'] is not None and read:
+            line = row['text'].rstrip() + "\n"
+            file_inp.write(line)
+    file_inp.close()
+
+    if gully:
+        aditional_path = folder_path.replace('.inp', '.gul')
+        aditional_file = open(aditional_path, "w")
+        read = True
+        save_file = False
+        for row in all_rows:
+            if bool(re.match(r'\[(.*?)\]', row['text'])) and \
+                    ('TITLE' in row['text'] or 'GULLY' in row['text'] or 'LINK' in row['text'] or
+                     'GRATE' in row['text'] or 'LXSECTIONS' in row['text']):
+                read = True
+                if 'GULLY' in row['text'] or 'LINK' in row['text'] or \
+                   'GRATE' in row['text'] or 'LXSECTIONS' in row['text']:
+                    save_file = True
+            elif bool(re.match(r'\[(.*?)\]', row['text'])):
+                read = False
+            if 'text' in row and row['text'] is not None and read:
+                line = row['text'].rstrip() + "\n"
+                aditional_file.write(line)
+        aditional_file.close()
+
+        if save_file is False:
+            os.remove(aditional_path)
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("rows", [ROWS_GULLY, ROWS_NO_GULLY])
+@pytest.mark.parametrize("gully", [True, False])
+def test_same_files_as_baseline(tmp_path, rows, gully):
+    baseline_inp = str(tmp_path / "baseline" / "result1.inp")
+    inp = str(tmp_path / "new" / "result1.inp")
+    os.makedirs(os.path.dirname(baseline_inp))
+    os.makedirs(os.path.dirname(inp))
+
+    _baseline_fill_inp_file(baseline_inp, [{'text': row} for row in rows], gully)
+    written = write_inp_files(iter(rows), inp, inp.replace('.inp', '.gul') if gully else None)
+
+    assert _read(inp) == _read(baseline_inp)
+    assert _read(inp.replace('.inp', '.gul')) == _read(baseline_inp.replace('.inp', '.gul'))
+    assert written == (gully and rows is ROWS_GULLY)
+
+
+def test_old_gul_file_removed(tmp_path):
+    inp = str(tmp_path / "result1.inp")
+    gul = str(tmp_path / "result1.gul")
+    with open(gul, "w") as file:
+        file.write("[GULLY]\n")
+
+    assert not write_inp_files(ROWS_NO_GULLY + [None], inp, gul)
+    assert not os.path.exists(gul)
@@ -0,0 +1,56 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import os
+
+from core.utils.jobs import STATUS_OK, JobQueue
+
+
+def _write(path, text):
+    with open(path, "w") as file:
+        file.write(text)
+
+
+def test_submit_removes_files_of_aborted_run(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    file_inp = str(tmp_path / "result1.inp")
+    file_rpt = str(tmp_path / "result1.rpt")
+    _write(file_inp, "[TITLE]\nold\n")
+
+    # Aborted run: a worker claimed the job, took it over and wrote part of the report
+    job = queue.submit("result1", file_inp, file_rpt)
+    assert queue.claim("result1")
+    _write(str(tmp_path / "result1.lock.1"), "{}")
+    _write(file_rpt, "partial")
+    queue.complete("result1", job, STATUS_OK)
+    _write(str(tmp_path / "result1.lock"), "{}")
+
+    _write(file_inp, "[TITLE]\nnew\n")
+    job = queue.submit("result1", file_inp, file_rpt)
+
+    assert not os.path.exists(file_rpt)
+    assert queue.get_result("result1") is None
+    assert list(queue.iter_pending()) == ["result1"]
+    assert queue.claim("result1")
+    assert queue.read_job("result1")["inp_hash"] == job["inp_hash"]
+
+
+def test_release_keeps_locks_of_new_submission(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    other = JobQueue(str(tmp_path))
+    file_inp = str(tmp_path / "result1.inp")
+    _write(file_inp, "[TITLE]\n")
+
+    queue.submit("result1", file_inp, str(tmp_path / "result1.rpt"))
+    assert queue.claim("result1")
+    other.submit("result1", file_inp, str(tmp_path / "result1.rpt"))
+    assert other.claim("result1")
+
+    # The worker of the first submission finishes late
+    queue.release("result1")
+    assert os.path.exists(str(tmp_path / "result1.lock"))
+    assert list(other.iter_pending()) == []
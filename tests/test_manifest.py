@@ -0,0 +1,58 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+from core.utils.manifest import STAGE_EXPORTED, STAGE_IMPORTED, STAGE_SIMULATED, RunManifest
+
+
+def _write(path, text):
+    with open(path, "w") as file:
+        file.write(text)
+    return str(path)
+
+
+def test_resume_stages(tmp_path):
+    path = str(tmp_path / "result-manifest.jsonl")
+    inp1 = _write(tmp_path / "result-1.inp", "[JUNCTIONS]\n")
+    inp2 = _write(tmp_path / "result-2.inp", "[JUNCTIONS]\n")
+    rpt1 = str(tmp_path / "result-1.rpt")
+    rpt2 = _write(tmp_path / "result-2.rpt", "Node Results\n")
+
+    manifest = RunManifest(path, "config1")
+    manifest.mark_exported("result-1", inp1)
+    manifest.mark("result-1", STAGE_SIMULATED)
+    manifest.mark_exported("result-2", inp2)
+    manifest.mark("result-2", STAGE_SIMULATED)
+    manifest.mark("result-3", STAGE_IMPORTED)
+    manifest.close()
+    # Killed while writing a line
+    with open(path, "a") as file:
+        file.write('{"scenario": "result-4", "sta')
+
+    manifest = RunManifest(path, "config1", resume=True)
+    assert manifest.resumed
+    # The RPT file of result-1 was removed, so it has to be simulated again
+    assert manifest.get_resume_stage("result-1", inp1, rpt1) == STAGE_EXPORTED
+    assert manifest.get_resume_stage("result-2", inp2, rpt2) == STAGE_SIMULATED
+    assert manifest.get_resume_stage("result-3", None, None) == STAGE_IMPORTED
+    assert manifest.get_resume_stage("result-4", None, None) is None
+
+    # The INP file changed after it was exported
+    _write(inp2, "[JUNCTIONS]\nJ1\n")
+    assert manifest.get_resume_stage("result-2", inp2, rpt2) is None
+    manifest.close()
+
+
+def test_other_config_not_resumed(tmp_path):
+    path = str(tmp_path / "result-manifest.jsonl")
+    manifest = RunManifest(path, "config1")
+    manifest.mark("result-1", STAGE_IMPORTED)
+    manifest.close()
+
+    manifest = RunManifest(path, "config2", resume=True)
+    assert not manifest.resumed
+    assert manifest.get_stage("result-1") is None
+    manifest.close()
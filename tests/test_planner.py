@@ -0,0 +1,47 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+from core.utils.planner import BatchPlan, load_history, save_history
+from core.utils.scenarios import TRAVERSAL_GRAY, ScenarioLevel
+
+LEVELS = [
+    ScenarioLevel(1, ["query $list1object"], [["a", "b"]]),
+    ScenarioLevel(2, ["query $list2object"], [["1", "2", "3"]]),
+]
+
+
+def test_result_names_in_baseline_order():
+    plan = BatchPlan(LEVELS, "result")
+
+    # The former nested loops: [list1] outermost, names from the innermost value
+    assert list(plan.iter_result_names()) == [f"result-{l2o}-{l1o}" for l1o in "ab" for l2o in "123"]
+    assert plan.scenarios == 6
+
+
+def test_gray_plan_has_same_results():
+    plan = BatchPlan(LEVELS, "result", traversal=TRAVERSAL_GRAY)
+
+    assert sorted(plan.iter_result_names()) == sorted(BatchPlan(LEVELS, "result").iter_result_names())
+
+
+def test_estimates_from_history(tmp_path):
+    history_file = str(tmp_path / "history.json")
+    summary = {
+        "wall_time": 30.0,
+        "phases": {
+            "inp_write": {"mean": 0.5, "bytes_mean": 1000},
+            "simulation": {"mean": 2.0, "bytes_mean": 3000},
+        },
+    }
+    save_history(history_file, "project.qgz", summary, 10)
+
+    plan = BatchPlan(LEVELS, "result", load_history(history_file, "project.qgz"))
+    assert plan.disk_usage == 6 * 4000
+    assert plan.runtime == 6 * 3.0
+    assert "simulation 2.00s" in plan.get_text()
+    assert load_history(history_file, "other.qgz") is None
+    assert BatchPlan(LEVELS, "result").runtime is None
@@ -0,0 +1,58 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import os
+
+from core.utils.result_cache import ResultCache
+
+
+def _write(path, text):
+    with open(path, "w") as file:
+        file.write(text)
+    return str(path)
+
+
+def test_key_ignores_comments(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    inp1 = _write(tmp_path / "result1.inp", ";Result: result1\n[JUNCTIONS]\nJ1  95\n")
+    inp2 = _write(tmp_path / "result2.inp", ";Result: result2\n[JUNCTIONS]\nJ1  95\n")
+    inp3 = _write(tmp_path / "result3.inp", ";Result: result3\n[JUNCTIONS]\nJ1  96\n")
+
+    assert cache.get_key(inp1, "executable") == cache.get_key(inp2, "executable")
+    assert cache.get_key(inp1, "executable") != cache.get_key(inp3, "executable")
+    assert cache.get_key(inp1, "executable") != cache.get_key(inp1, "toolkit")
+
+
+def test_fetch_returns_stored_report(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    inp = _write(tmp_path / "result1.inp", "[JUNCTIONS]\nJ1  95\n")
+    rpt = _write(tmp_path / "result1.rpt", "Node Results\n")
+    key = cache.get_key(inp)
+    copy = str(tmp_path / "copy.rpt")
+
+    assert not cache.fetch(key, copy)
+    cache.store(key, rpt)
+    assert cache.fetch(key, copy)
+    with open(copy) as file:
+        assert file.read() == "Node Results\n"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_size=25)
+    keys = []
+    for i in range(3):
+        rpt = _write(tmp_path / f"result{i}.rpt", "x" * 10)
+        keys.append(f"{i:02d}" * 32)
+        cache.store(keys[-1], rpt)
+        # Every file is used later than the previous one
+        path = os.path.join(cache.folder, keys[-1][:2], f"{keys[-1]}.rpt")
+        os.utime(path, (i, i))
+
+    assert cache.get_size() <= 25
+    assert not cache.fetch(keys[0], str(tmp_path / "copy.rpt"))
+    assert cache.fetch(keys[2], str(tmp_path / "copy.rpt"))
@@ -0,0 +1,177 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import json
+import re
+
+import pytest
+
+from core.utils.rpt_parser import COPY_COLUMNS, RptParseError, get_rpt_sources, iter_copy_lines, iter_rpt_rows, \
+    parse_rpt_file
+
+# Rows of config_fprocess (tablename, target). 'Node' is also a target of its own, defined later
+SOURCES = [
+    ("rpt_cat_result", "{Version}"),
+    ("rpt_node", "{Node Results}"),
+    ("rpt_arc", "{Link Results, Link}"),
+    ("rpt_energy", "{Energy Usage}"),
+    ("rpt_node_aux", "{Node}"),
+]
+
+RPT_WS = """\
+  Page 1                                    Thu Jan 01 00:00:00 2024
+  ******************************************************************
+  *                E P A N E T                                     *
+  ******************************************************************
+  Version 2.2.0 build 1.2.3
+
+  Input Data File ................... test.inp
+
+  Node Results at 0:00:00 hrs:
+  ----------------------------------------------------
+                     Demand      Head  Pressure
+  Node                  LPS         m         m
+  ----------------------------------------------------
+  1038              16.67     95.12     25.12
+  1035               0.00     94.10     24.10  Reservoir
+
+  Node Results at 01:00:00 hrs:
+  1041               1.5e-05   10.1-12.3    5.5
+  Link Results at 0:00:00 hrs:
+  Link
+  L1     10.00  0.50  1.2-1.3
+  Energy Usage:
+  Pump1  ''  50.0
+"""
+
+RPT_UD = """\
+  Link Results
+  C1     >50  0.50  1.20
+  Link
+"""
+
+
+def _baseline_json_rpt(text, sources_rows, project_type):
+    """ JSON built by the former _read_rpt_file of the task, or None if the report was rejected """
+
+    sources = {}
+    for row in sources_rows:
+        json_elem = row[1].replace('{', '').replace('}', '')
+        item = json_elem.split(',')
+        for i in item:
+            sources[i.strip()] = row[0].strip()
+
+    target = "null"
+    col40 = "null"
+    json_rpt = ""
+    for line_number, row in enumerate(text.splitlines(keepends=True)):
+        if '**' in row or '--' in row:
+            continue
+        if project_type == 'ud' and '>50' in row:
+            row = row.replace('>50', '50')
+        row = row.rstrip()
+        dirty_list = row.split(' ')
+        for x in range(len(dirty_list) - 1, -1, -1):
+            if dirty_list[x] == '':
+                dirty_list.pop(x)
+
+        sp_n = []
+        if len(dirty_list) > 0:
+            for x in range(0, len(dirty_list)):
+                if bool(re.search(r'[0-9][-]\d{1,2}[.]]*', str(dirty_list[x]))):
+                    last_index = 0
+                    for i, c in enumerate(dirty_list[x]):
+                        if "-" == c:
+                            json_elem = dirty_list[x][last_index:i]
+                            last_index = i
+                            sp_n.append(json_elem)
+                    json_elem = dirty_list[x][last_index:i]
+                    sp_n.append(json_elem)
+                elif bool(re.search(r'(\d\..*\.\d)', str(dirty_list[x]))):
+                    if 'Version' not in dirty_list and 'VERSION' not in dirty_list:
+                        return None
+                elif bool(re.search('>50', str(dirty_list[x]))):
+                    return None
+                else:
+                    sp_n.append(dirty_list[x])
+
+        for k, v in sources.items():
+            try:
+                if k in (f'{sp_n[0]} {sp_n[1]}', f'{sp_n[0]}'):
+                    target = "'" + v + "'"
+                    _time = re.compile('^([012]?[0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]$')
+                    if _time.search(sp_n[3]):
+                        col40 = "'" + sp_n[3] + "'"
+            except IndexError:
+                pass
+
+        if len(sp_n) > 0:
+            json_elem = f'"target": "{target}", "col40": "{col40}", '
+            for x in range(0, len(sp_n)):
+                json_elem += f'"col{x + 1}":'
+                if "''" not in sp_n[x]:
+                    value = '"' + sp_n[x].strip().replace("\n", "") + '", '
+                    value = value.replace("''", "null")
+                else:
+                    value = 'null, '
+                json_elem += value
+            json_elem = '{' + str(json_elem[:-2]) + '}, '
+            json_rpt += json_elem
+
+    return '[' + str(json_rpt[:-2]) + ']'
+
+
+def _write_rpt(tmp_path, text):
+    path = tmp_path / "result.rpt"
+    path.write_text(text)
+    return str(path)
+
+
+@pytest.mark.parametrize("text, project_type", [(RPT_WS, 'ws'), (RPT_UD, 'ud'), ("", 'ws')])
+def test_same_json_as_baseline(tmp_path, text, project_type):
+    file_rpt = _write_rpt(tmp_path, text)
+
+    parsed = parse_rpt_file(file_rpt, get_rpt_sources(SOURCES), project_type)
+
+    assert parsed == _baseline_json_rpt(text, SOURCES, project_type)
+    json.loads(parsed)
+
+
+@pytest.mark.parametrize("text, project_type", [
+    ("  Node Results\n  5  1.2.3\n", 'ws'),
+    ("  Link Results\n  C1  >50  0.5\n", 'ws'),
+])
+def test_rejected_like_baseline(tmp_path, text, project_type):
+    file_rpt = _write_rpt(tmp_path, text)
+
+    assert _baseline_json_rpt(text, SOURCES, project_type) is None
+    with pytest.raises(RptParseError) as error:
+        parse_rpt_file(file_rpt, get_rpt_sources(SOURCES), project_type)
+    assert error.value.line_number == 2
+
+
+def test_copy_lines_match_rows(tmp_path):
+    file_rpt = _write_rpt(tmp_path, RPT_WS)
+    rows = list(iter_rpt_rows(file_rpt, get_rpt_sources(SOURCES), 'ws'))
+
+    lines = list(iter_copy_lines(rows, "result1"))
+
+    assert len(lines) == len(rows)
+    for line_id, (line, (target, col40, columns)) in enumerate(zip(lines, rows), 1):
+        values = line.rstrip("\n").split("\t")
+        assert values[:4] == ["result1", str(line_id), target, col40]
+        assert len(values) == 4 + COPY_COLUMNS
+        expected = [r'\N' if "''" in value else value.strip() for value in columns]
+        assert values[4:4 + len(columns)] == expected
+        assert set(values[4 + len(columns):]) <= {r'\N'}
+
+
+def test_copy_lines_reject_wide_rows():
+    rows = [("'rpt_node'", "null", ["1"] * (COPY_COLUMNS + 1))]
+
+    with pytest.raises(RptParseError):
+        list(iter_copy_lines(rows, "result1"))
@@ -0,0 +1,161 @@
+"""
+Copyright © 2023 by BGEO. All rights reserved.
+The program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+"""
+# -*- coding: utf-8 -*-
+import pytest
+
+from core.utils.scenarios import TRAVERSAL_GRAY, TRAVERSAL_NESTED, count_scenarios, get_pending_levels, \
+    get_prepared_statement, get_result_name, iter_scenarios, read_levels, read_traversal
+
+PLACEHOLDER = "$list1object"
+
+# Same lists as resources/examples/anl_epa_multi_calls/example.config, with two queries in [list1]
+CONFIG = {
+    "list1/query1": "UPDATE config_param_user SET value = '$list1object' WHERE parameter = 'inp_options_demand'",
+    "list1/list1": ["0.5", "1"],
+    "list1/query2": "UPDATE config_param_user SET value = '$list1object' WHERE parameter = 'inp_options_pattern'",
+    "list1/list2": "P1",
+    "list2/query1": "UPDATE selector_inp_dscenario SET dscenario_id = $list2object WHERE cur_user = current_user",
+    "list2/list1": ["1", "2", "3"],
+    "list3/query1": "UPDATE v_edit_inp_dscenario_lid_usage SET numelem = $list3object",
+    "list3/list1": "4",
+    "options/traversal": None,
+}
+
+
+class Settings:
+    """ Values of a config file, as returned by QSettings """
+
+    def __init__(self, values):
+        self.values = values
+
+    def value(self, key):
+        return self.values.get(key)
+
+
+def _baseline_events(settings, prefix):
+    """ Queries and exports of the former nested loops of the task (up to three lists) """
+
+    def get_queries_and_lists(number):
+        queries = []
+        lists = []
+        for i in range(1, 20):
+            query = settings.value(f"list{number}/query{i}")
+            list_str = settings.value(f"list{number}/list{i}")
+            if not query or not list_str:
+                break
+            queries.append(query)
+            if not issubclass(type(list_str), list):
+                list_str = [list_str]
+            lists.append(list_str)
+        return queries, lists
+
+    def run_go2epa(l1o=None, l2o=None, l3o=None):
+        resultname = f"{prefix}"
+        if l3o:
+            resultname += f"-{l3o}"
+        if l2o:
+            resultname += f"-{l2o}"
+        if l1o:
+            resultname += f"-{l1o}"
+        events.append(("export", resultname))
+
+    events = []
+    queries1, lists1 = get_queries_and_lists(1)
+    queries2, lists2 = get_queries_and_lists(2)
+    queries3, lists3 = get_queries_and_lists(3)
+    for idx1, query1 in enumerate(queries1):
+        for l1o in lists1[idx1]:
+            events.append(("query", query1.replace("$list1object", l1o)))
+            if not queries2 or not lists2:
+                run_go2epa(l1o)
+                continue
+            for idx2, query2 in enumerate(queries2):
+                for l2o in lists2[idx2]:
+                    events.append(("query", query2.replace("$list2object", l2o)))
+                    if not queries3 or not lists3:
+                        run_go2epa(l1o, l2o)
+                        continue
+                    for idx3, query3 in enumerate(queries3):
+                        for l3o in lists3[idx3]:
+                            events.append(("query", query3.replace("$list3object", l3o)))
+                            run_go2epa(l1o, l2o, l3o)
+    return events
+
+
+def _get_events(levels, prefix, traversal):
+    """ Queries and exports of the serial export of the task (see GwRecursiveEpa._export_serial) """
+
+    events = []
+    applied = [None] * len(levels)
+    for states, _ in iter_scenarios(levels, traversal):
+        for level_idx in get_pending_levels(applied, states, traversal):
+            previous = applied[level_idx]
+            applied[level_idx] = states[level_idx]
+            level = levels[level_idx]
+            if traversal == TRAVERSAL_GRAY and previous is not None and \
+                    level.states[previous] == level.states[states[level_idx]]:
+                continue
+            events.append(("query", level.get_query(states[level_idx])))
+        values = [level.get_value(state) for level, state in zip(levels, states)]
+        events.append(("export", get_result_name(prefix, values)))
+    return events
+
+
+@pytest.mark.parametrize("numbers", [(1,), (1, 2), (1, 2, 3)])
+def test_nested_is_baseline_order(numbers):
+    settings = Settings({key: value for key, value in CONFIG.items()
+                         if not key.startswith("list") or int(key[4]) in numbers})
+    levels = read_levels(settings)
+
+    assert len(levels) == len(numbers)
+    assert read_traversal(settings) == TRAVERSAL_NESTED
+    events = _get_events(levels, "result", read_traversal(settings))
+    assert events == _baseline_events(settings, "result")
+    assert count_scenarios(levels) == sum(1 for event, _ in events if event == "export")
+
+
+def test_iter_scenarios_defaults_to_nested():
+    levels = read_levels(Settings(CONFIG))
+
+    assert list(iter_scenarios(levels)) == list(iter_scenarios(levels, TRAVERSAL_NESTED))
+    assert get_pending_levels((0, 0, 0), (1, 0, 0)) == (0, 1, 2)
+
+
+def test_gray_exports_same_scenarios():
+    levels = read_levels(Settings(CONFIG))
+
+    scenarios = list(iter_scenarios(levels, TRAVERSAL_GRAY))
+    assert sorted(states for states, _ in scenarios) == sorted(states for states, _ in iter_scenarios(levels))
+    assert all(len(changed) == 1 for _, changed in scenarios[1:])
+    assert read_traversal(Settings({"options/traversal": "Gray"})) == TRAVERSAL_GRAY
+    assert read_traversal(Settings({"options/traversal": "zigzag"})) is None
+
+
+def test_prepared_statement():
+    query = "UPDATE inp_junction SET demand = $list1object WHERE node_id = 'it''s';"
+    assert get_prepared_statement(query, PLACEHOLDER) == \
+        "UPDATE inp_junction SET demand = $1 WHERE node_id = 'it''s'"
+    assert get_prepared_statement("SELECT unnest($list1object::integer[])", PLACEHOLDER) == \
+        "SELECT unnest($1::integer[])"
+
+
+def test_quote_types_are_tracked_separately():
+    # An apostrophe inside an identifier doesn't open a literal, and a double quote inside a literal
+    # doesn't open an identifier
+    assert get_prepared_statement('UPDATE "it\'s" SET demand = $list1object', PLACEHOLDER) == \
+        'UPDATE "it\'s" SET demand = $1'
+    assert get_prepared_statement("SELECT '\"' || $list1object", PLACEHOLDER) == "SELECT '\"' || $1"
+    assert get_prepared_statement('SELECT "a\'b" || $list1object || \'x\'', PLACEHOLDER) == \
+        'SELECT "a\'b" || $1 || \'x\''
+
+
+def test_unprepared_statements():
+    assert get_prepared_statement("UPDATE inp_junction SET demand = '$list1object'", PLACEHOLDER) is None
+    assert get_prepared_statement('SELECT "$list1object"', PLACEHOLDER) is None
+    assert get_prepared_statement("SELECT '\"' || '$list1object'", PLACEHOLDER) is None
+    assert get_prepared_statement("UPDATE a SET b = $list1object; UPDATE c SET d = 1", PLACEHOLDER) is None
+    assert get_prepared_statement("UPDATE a SET b = 1", PLACEHOLDER) is None